@@ -1,13 +1,62 @@
-from setup import app
-from jwt_config import jwt
-from blueprints.cli_bp import db_commands
-from blueprints.pantry_bp import pantry_bp
-from blueprints.users_bp import users_bp
+from dotenv import load_dotenv
+from flask import Flask
+
+
+# Builds the app. 'config' holds settings that take precedence over the environment variables, e.g. for tests, benchmarks or scripts.
+# The blueprints, models and the extensions' helpers are imported here rather than at the top of the module,
+# so importing this module (or setup.py, or a model) is cheap and has no side effects. Everything is only loaded once an app is actually built.
+# The extensions (db, password_hasher, jwt, the caches, the replica router and the profiler) are module level objects shared by the whole process,
+# so only one app per process is supported. Building another one, e.g. in a script, reconfigures them from scratch for the new app,
+# and the apps built before it must not be used anymore.
+def create_app(config=None):
+    # Load environment variables
+    load_dotenv()
+
+    from setup import db, password_hasher, ma, configure_app
+    from db_pool import engine_options
+    from db_routing import replica_router
+    from json_provider import FastJSONProvider
+
+    # Initialize Flask app
+    app = Flask(__name__)
+    configure_app(app)
+    if config:
+        app.config.update(config)
+    # The engine options are built once any overridden DB_* settings are in place.
+    if not config or 'SQLALCHEMY_ENGINE_OPTIONS' not in config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+    # Use the faster JSON provider (orjson when it is installed) for every JSON response.
+    app.json = FastJSONProvider(app)
+
+    # Bind the extensions to the app.
+    db.init_app(app)
+    replica_router.init_app(app)
+    password_hasher.init_app(app)
+    ma.init_app(app)
+
+    from jwt_config import jwt
+    from blueprints.cli_bp import db_commands
+    from blueprints.pantry_bp import pantry_bp
+    from blueprints.users_bp import users_bp
+    from token_cache import init_revoked_token_cache, start_revoked_token_purger
+    from response_cache import response_cache
+    from profiling import request_profiler
+
+    app.register_blueprint(db_commands)
+    app.register_blueprint(users_bp)
+    app.register_blueprint(pantry_bp)
+    # The metrics route is only registered when it has been enabled.
+    if app.config['METRICS_ENABLED']:
+        from blueprints.metrics_bp import metrics_bp
+        app.register_blueprint(metrics_bp)
+    jwt.init_app(app)
+    init_revoked_token_cache(app)
+    start_revoked_token_purger(app)
+    response_cache.init_app(app)
+    request_profiler.init_app(app)
+    return app
 
-app.register_blueprint(db_commands)
-app.register_blueprint(users_bp)
-app.register_blueprint(pantry_bp)
-jwt.init_app(app)
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
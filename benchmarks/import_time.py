@@ -0,0 +1,63 @@
+# Measures the cold start of the app: the time to import its modules and the time to build it with create_app, each in a fresh interpreter,
+# and lists the slowest imports (from python -X importtime). With --budget it fails (exit status 1) when building the app takes longer,
+# so it can be run in CI to catch a change that slows down startup.
+# Run from the root of the repository: python benchmarks/import_time.py --repeat 5 --budget 1500
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What is measured, each in its own interpreter so nothing is already imported.
+TARGETS = [
+    ('import setup', 'import setup'),
+    ('import app', 'import app'),
+    ('create_app()', 'from app import create_app; create_app()'),
+]
+
+# Parses the output of python -X importtime into the cumulative time (in microseconds) of each top level import,
+# i.e. the imports made by the measured statement itself rather than by another module.
+def parse_importtime(output):
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+# Runs the statement in a fresh interpreter and returns how long it took in seconds, along with its top level imports.
+def measure(statement):
+    code = f'import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(result.stdout.splitlines()[-1]), parse_importtime(result.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import time and startup time of the app.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each target, the fastest is reported.')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list.')
+    parser.add_argument('--budget', type=float, default=None, help='Maximum time in milliseconds create_app() may take.')
+    args = parser.parse_args()
+
+    results = {}
+    for label, statement in TARGETS:
+        runs = [measure(statement) for _ in range(args.repeat)]
+        results[label] = min(runs, key=lambda run: run[0])
+        print(f"{label:<14} {results[label][0] * 1000:>8.1f} ms")
+
+    print("\nSlowest imports of create_app() (cumulative):")
+    imports = results['create_app()'][1]
+    for name, cumulative in sorted(imports.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:>8.1f} ms  {name}")
+
+    if args.budget is not None:
+        elapsed = results['create_app()'][0] * 1000
+        if elapsed > args.budget:
+            print(f"\ncreate_app() took {elapsed:.1f} ms, over the budget of {args.budget:.1f} ms")
+            sys.exit(1)
+        print(f"\ncreate_app() is within the budget of {args.budget:.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Measures login throughput (bcrypt password checks per second) at several bcrypt work factors,
+# hashing on the calling thread and offloaded to the pool of worker processes used by PasswordHasher.
+# Run from the root of the repository: python benchmarks/password_hashing.py --costs 10 12 --workers 4
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Allow the app modules to be imported when the script is run from the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashing import PasswordHasher
+
+PASSWORD = 'Passw0rd!'
+
+def make_hasher(rounds, workers):
+    hasher = PasswordHasher()
+    hasher.configure(rounds, workers)
+    return hasher
+
+# Runs 'logins' password checks from 'concurrency' threads, like concurrent login requests, and returns the checks per second.
+def measure(hasher, hashed, logins, concurrency):
+    # Warm up the pool so starting the worker processes isn't measured.
+    hasher.check_hash(hashed, PASSWORD)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: hasher.check_hash(hashed, PASSWORD), range(logins)))
+    elapsed = time.perf_counter() - start
+    assert all(results)
+    return logins / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bcrypt password checks at several work factors.')
+    parser.add_argument('--costs', type=int, nargs='+', default=[4, 8, 10, 12], help='bcrypt work factors (log rounds) to measure.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of hashing worker processes for the offloaded run.')
+    parser.add_argument('--seconds', type=float, default=2.0, help='Approximate duration of each run.')
+    args = parser.parse_args()
+
+    print(f"{'cost':>4} {'ms/check':>10} {'inline logins/s':>16} {f'pool({args.workers}) logins/s':>18} {'per core':>10}")
+    for cost in args.costs:
+        inline = make_hasher(cost, 0)
+        hashed = inline.generate_hash(PASSWORD)
+        # Size each run from the time of a single check so every cost factor takes roughly the same time.
+        start = time.perf_counter()
+        inline.check_hash(hashed, PASSWORD)
+        single = time.perf_counter() - start
+        logins = max(args.workers * 2, int(args.seconds / single))
+
+        inline_rate = measure(inline, hashed, max(1, logins // args.workers), 1)
+        pooled = make_hasher(cost, args.workers)
+        pooled_rate = measure(pooled, hashed, logins, args.workers * 2)
+        pooled.pool.shutdown()
+        print(f"{cost:>4} {single * 1000:>10.2f} {inline_rate:>16.1f} {pooled_rate:>18.1f} {pooled_rate / args.workers:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,184 @@
-from flask import Blueprint
-from setup import db,app
+import click
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from flask import Blueprint, current_app
+from sqlalchemy import text, select
+from setup import db, password_hasher
+from hashing import hash_version
 from models.user import User
-from models.pantry import Pantry, PantryItem
+from models.pantry import Pantry, PantryItem, PantryChange
 from models.authorization import RevokedToken
+from seeding import seed, is_valid_prefix, DEFAULT_PASSWORD, DEFAULT_SECURITY_ANSWER, PREFIX_ERROR
 
 # Create a new blueprint named 'db'. This allows us to organize Flask application into smaller and reusable applications.
-db_commands = Blueprint('db', __name__)
+# Its commands are registered with the app along with the blueprint. cli_group=None makes them top level commands ('flask create' rather than 'flask db create').
+db_commands = Blueprint('db', __name__, cli_group=None)
 
 # Register a new command 'create' that can be run in the Flask application's command line interface (CLI).
-@app.cli.command('create')
+@db_commands.cli.command('create')
 def create_db():
-    # 'app_context()' is a context manager that binds the application instance to the current context.
-    # This is necessary because Flask uses a concept of application contexts and request contexts.
     # Some operations (like database operations) can only be performed within an application context.
-    with app.app_context():
-        # 'create_all()' is a method that creates all tables defined in our SQLAlchemy models.
-        db.create_all()
-        # Print a success message to the console.
-        print("Tables created successfully")
\ No newline at end of file
+    # Flask runs the commands of a blueprint inside one, so there's no need to push it here.
+    # 'create_all()' is a method that creates all tables defined in our SQLAlchemy models.
+    # Only on the primary database, the read replicas get their tables through replication.
+    db.create_all(bind_key=None)
+    # Print a success message to the console.
+    print("Tables created successfully")
+
+# 'create_all()' only creates tables that don't exist yet, it never alters an existing table.
+# These steps bring a database created by an older version of the app up to date with the models. Every statement is idempotent,
+# so 'flask upgrade' can safely be run on every deploy. The statements are PostgreSQL specific since that is the database this app runs on.
+UPGRADE_STEPS = [
+    ("Add expires_at to revoked_tokens", [
+        "ALTER TABLE revoked_tokens ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP WITH TIME ZONE",
+        # Tokens are issued for 1 hour, so an hour from now is a safe upper bound for tokens revoked before this column existed.
+        "UPDATE revoked_tokens SET expires_at = now() + interval '1 hour' WHERE expires_at IS NULL",
+        "ALTER TABLE revoked_tokens ALTER COLUMN expires_at SET NOT NULL",
+        "CREATE INDEX IF NOT EXISTS ix_revoked_tokens_expires_at ON revoked_tokens (expires_at)",
+    ]),
+    ("Add unique index on revoked_tokens.jti", [
+        # Remove any duplicate jti so the unique index can be built.
+        "DELETE FROM revoked_tokens a USING revoked_tokens b WHERE a.id > b.id AND a.jti = b.jti",
+        "DELETE FROM revoked_tokens WHERE jti IS NULL",
+        "ALTER TABLE revoked_tokens ALTER COLUMN jti SET NOT NULL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_revoked_tokens_jti ON revoked_tokens (jti)",
+    ]),
+    ("Convert pantry_items.used_by_date to a date column", [
+        # The dates were validated as 'yyyy-mm-dd' before being stored as text, so every existing row can be cast.
+        # The check makes the step a no-op once the column has been converted, instead of rewriting the table on every run.
+        """DO $$ BEGIN
+            IF (SELECT data_type FROM information_schema.columns WHERE table_name = 'pantry_items' AND column_name = 'used_by_date') <> 'date' THEN
+                ALTER TABLE pantry_items ALTER COLUMN used_by_date TYPE date USING CAST(used_by_date AS date);
+            END IF;
+        END $$""",
+    ]),
+    ("Add composite indexes on pantry_items", [
+        "CREATE INDEX IF NOT EXISTS ix_pantry_items_pantry_id_used_by_date ON pantry_items (pantry_id, used_by_date)",
+        "CREATE INDEX IF NOT EXISTS ix_pantry_items_pantry_id_count ON pantry_items (pantry_id, count)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_pantry_items_pantry_id_item ON pantry_items (pantry_id, item)",
+        # Every index above starts with pantry_id, so the single column index an earlier version created is no longer needed.
+        # It used to be created by a step of its own, which was removed so each upgrade doesn't build it only to drop it here.
+        "DROP INDEX IF EXISTS ix_pantry_items_pantry_id",
+    ]),
+    ("Add version and updated_at to pantries", [
+        "ALTER TABLE pantries ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE pantries ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+    ]),
+    ("Add the pantry change log", [
+        "ALTER TABLE pantries ADD COLUMN IF NOT EXISTS changes_floor INTEGER NOT NULL DEFAULT 0",
+        """CREATE TABLE IF NOT EXISTS pantry_changes (
+            id SERIAL PRIMARY KEY,
+            pantry_id INTEGER NOT NULL REFERENCES pantries (pantry_id),
+            item TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            deleted BOOLEAN NOT NULL,
+            changed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_pantry_changes_pantry_id_item ON pantry_changes (pantry_id, item)",
+        "CREATE INDEX IF NOT EXISTS ix_pantry_changes_pantry_id_version ON pantry_changes (pantry_id, version)",
+        # The items that existed before the log are recorded as changed at their pantry's current version.
+        """INSERT INTO pantry_changes (pantry_id, item, version, deleted)
+            SELECT pantry_items.pantry_id, pantry_items.item, pantries.version, false
+            FROM pantry_items JOIN pantries ON pantries.pantry_id = pantry_items.pantry_id
+            ON CONFLICT (pantry_id, item) DO NOTHING""",
+    ]),
+    ("Check that usernames, emails and item names are stored in lowercase", [
+        # The app has always lowercased them, so existing rows already pass. PostgreSQL has no ADD CONSTRAINT IF NOT EXISTS, hence the checks.
+        """DO $$ BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ck_users_username_lowercase') THEN
+                ALTER TABLE users ADD CONSTRAINT ck_users_username_lowercase CHECK (username = lower(username));
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ck_users_email_lowercase') THEN
+                ALTER TABLE users ADD CONSTRAINT ck_users_email_lowercase CHECK (email = lower(email));
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ck_pantry_items_item_lowercase') THEN
+                ALTER TABLE pantry_items ADD CONSTRAINT ck_pantry_items_item_lowercase CHECK (item = lower(item));
+            END IF;
+        END $$""",
+    ]),
+]
+
+@db_commands.cli.command('upgrade')
+def upgrade_db():
+    for description, statements in UPGRADE_STEPS:
+        for statement in statements:
+            db.session.execute(text(statement))
+        # Each step is committed on its own so a failure in a later step doesn't undo the earlier ones.
+        db.session.commit()
+        print(f"{description}: done")
+
+# Rejects a --prefix the database would reject, before anything is written.
+def validate_prefix(ctx, param, value):
+    if not is_valid_prefix(value):
+        raise click.BadParameter(PREFIX_ERROR)
+    return value
+
+# Generates large synthetic datasets, e.g. to reproduce production scale locally or for benchmarks: 'flask seed --users 1000000 --items 50'.
+# The rows are written in bulk (with COPY on PostgreSQL) rather than one ORM object at a time, see seeding.py.
+# Every generated user can log in with the password and security answer given here. Run it again with another --prefix (or --start) to add more users.
+@db_commands.cli.command('seed')
+@click.option('--users', default=1000, type=int, help='Number of users to generate.')
+@click.option('--items', default=20, type=int, help='Number of pantry items per user.')
+@click.option('--prefix', default='seeduser', callback=validate_prefix, help='Usernames are the prefix (lowercase letters and digits) followed by a number.')
+@click.option('--start', default=0, type=int, help='Number of the first generated user.')
+@click.option('--batch-size', default=1000, type=int, help='Number of users generated per transaction.')
+@click.option('--password', default=DEFAULT_PASSWORD, help='Password of every generated user.')
+@click.option('--security-answer', default=DEFAULT_SECURITY_ANSWER, help='Security answer of every generated user.')
+def seed_db(users, items, prefix, start, batch_size, password, security_answer):
+    started = time.perf_counter()
+
+    def progress(done):
+        print(f"{done}/{users} users generated ({time.perf_counter() - started:.1f}s)")
+    seed(users, items, prefix, start, batch_size, password, security_answer, progress)
+    print(f"Generated {users} users and {users * items} pantry items in {time.perf_counter() - started:.1f}s")
+
+# Deletes the revoked tokens that have expired. This can be scheduled (e.g. with cron) instead of, or as well as, the in-process purge thread.
+@db_commands.cli.command('purge-tokens')
+@click.option('--batch-size', default=None, type=int, help='Number of rows deleted per transaction.')
+def purge_tokens(batch_size):
+    purged = RevokedToken.purge_expired(batch_size or current_app.config['REVOKED_TOKEN_PURGE_BATCH'])
+    print(f"Purged {purged} expired revoked tokens")
+
+# Deletes the deletions (tombstones) older than --days from the pantry change log. Clients that haven't synced since then have to sync their whole pantry again.
+# Like purge-tokens, this can be scheduled (e.g. with cron).
+@db_commands.cli.command('compact-changes')
+@click.option('--days', default=None, type=int, help='Keep the deletions of the last DAYS days.')
+@click.option('--batch-size', default=None, type=int, help='Number of rows deleted per transaction.')
+def compact_changes(days, batch_size):
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days or current_app.config['PANTRY_CHANGES_RETENTION_DAYS'])
+    compacted = PantryChange.compact(cutoff, batch_size or current_app.config['PANTRY_CHANGES_COMPACT_BATCH'])
+    print(f"Compacted {compacted} pantry change log entries")
+
+# Runs the app in production under gunicorn, see server.py and "Running in production" in the README.
+# - SIGHUP (kill -HUP <master pid>) gracefully replaces the workers: new workers are started and the old ones finish their current requests first.
+#   Since the app is preloaded in the master, new code is deployed by starting a new master instead: SIGUSR2 starts one next to the old master,
+#   then SIGQUIT to the old master stops it once the new one is running.
+# - In gevent mode the standard library must be patched before the app is imported, so the app has to be loaded from wsgi.py.
+#   Flask looks for wsgi.py before app.py, so that is what a plain 'flask serve' does.
+@db_commands.cli.command('serve')
+@click.option('--bind', default=None, help='Address to listen on, e.g. 0.0.0.0:8000.')
+@click.option('--workers', default=None, type=int, help='Number of worker processes.')
+@click.option('--threads', default=None, type=int, help='Number of threads per worker process (threaded mode).')
+def serve(bind, workers, threads):
+    if current_app.config['SERVER_MODE'] == 'gevent':
+        from gevent import monkey
+        if not monkey.is_module_patched('socket'):
+            raise click.UsageError("SERVER_MODE=gevent requires loading the app through wsgi.py: flask --app wsgi serve")
+    # gunicorn is only imported here since it is only needed by this command (and doesn't run on Windows).
+    from server import Server, server_options
+    app = current_app._get_current_object()
+    Server(app, server_options(app, bind, workers, threads)).run()
+
+# Reports how many accounts have their password and security answer hashed with each scheme and cost,
+# to follow the migration to new hashing settings (accounts are rehashed as they log in).
+@db_commands.cli.command('hash-stats')
+def hash_stats():
+    print(f"Current hashing settings: {password_hasher.current_version}")
+    for field in ('password_hash', 'security_answer'):
+        # Only the hash column is read, in batches, so this doesn't load every user into memory.
+        hashes = db.session.execute(select(getattr(User, field)).execution_options(yield_per=10000)).scalars()
+        counts = Counter(hash_version(hashed) for hashed in hashes)
+        print(f"{field}:")
+        for version, count in counts.most_common():
+            print(f"  {version}: {count}" + (" (current)" if version == password_hasher.current_version else ""))
@@ -0,0 +1,43 @@
+import os
+from flask import Blueprint, Response
+from setup import db
+from db_pool import InstrumentedQueuePool
+from metrics import render_histogram, render_sample
+from profiling import request_profiler
+
+# This blueprint is only registered when METRICS_ENABLED is set, since the metrics are not behind a login.
+metrics_bp = Blueprint('metrics', __name__)
+
+# The pool metrics exposed for each engine: (name, type, help, function reading the value from the pool).
+POOL_GAUGES = [
+    ('db_pool_size', 'gauge', 'Number of connections the pool keeps open.', lambda pool: pool.size()),
+    ('db_pool_checked_out', 'gauge', 'Number of connections currently in use.', lambda pool: pool.checkedout()),
+    ('db_pool_checked_in', 'gauge', 'Number of idle connections in the pool.', lambda pool: pool.checkedin()),
+    ('db_pool_overflow', 'gauge', 'Number of connections opened beyond the pool size.', lambda pool: pool.overflow()),
+    ('db_pool_checkout_timeouts_total', 'counter', 'Number of checkouts that timed out waiting for a connection.', lambda pool: pool.checkout_timeouts),
+]
+
+# Renders the metrics of every instrumented connection pool. Each label set identifies the engine ('bind') and the server process,
+# since every process has its own pools.
+def pool_metrics():
+    pools = [
+        ({'bind': bind_key or 'default', 'process': os.getpid()}, engine.pool)
+        for bind_key, engine in db.engines.items()
+        if isinstance(engine.pool, InstrumentedQueuePool)
+    ]
+    lines = []
+    for name, metric_type, description, read in POOL_GAUGES:
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+        lines += [render_sample(name, read(pool), labels) for labels, pool in pools]
+    lines += ['# HELP db_pool_checkout_seconds Time taken to check a connection out of the pool.', '# TYPE db_pool_checkout_seconds histogram']
+    for labels, pool in pools:
+        lines += render_histogram('db_pool_checkout_seconds', pool.checkout_wait, labels)
+    return lines
+
+# Exposes the metrics in the Prometheus text format. The request timings are only included when PROFILING_ENABLED is set.
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    lines = pool_metrics()
+    if request_profiler.enabled:
+        lines += request_profiler.metrics()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -1,16 +1,46 @@
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required
+import base64
+import csv
+import io
+from functools import lru_cache
+from flask import Blueprint, request, current_app, Response, stream_with_context
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime
-from jwt_config import get_current_user
-from models.pantry import PantryItem, PantryItemSchema,UpdatePantryItemSchema,Pantry
-from models.user import User
-from utils import validate_data, validate_fields, prepare_data_dict, create_response, check_no_change,get_user_pantry_query
+from jwt_config import get_current_pantry_id
+from db_routing import read_replica, replica_router
+from response_cache import cached_response, response_cache, if_match_versions
+from models.pantry import Pantry, PantryChange, PantryItem, PantryItemSchema,UpdatePantryItemSchema,DeletePantryItemSchema
+from utils import validate_data, validate_fields, prepare_data_dict, create_response, check_no_change,get_pantry_query,get_pantry_item_query,load_json_list,get_field_errors,parse_whole_number
 from setup import db
-from sqlalchemy import cast, Date
+from profiling import timed
 from datetime import timedelta
+from sqlalchemy import case, delete, select
+from sqlalchemy.dialects.postgresql import insert
 
 pantry_bp = Blueprint('pantry', __name__, url_prefix='/pantry')
 
+# After a successful change to a pantry, the user's reads stay on the primary database for a short while (see ReplicaRouter),
+# so they don't read stale data from a replica that hasn't caught up with their change yet. The end of that window is sent back with the response.
+# The pantry's cached responses are invalidated too. This runs once the route has committed, so a read can't cache the data from before the change.
+@pantry_bp.after_request
+def record_pantry_write(response):
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+        replica_router.sticky_response(get_jwt_identity(), response)
+        response_cache.invalidate(get_current_pantry_id())
+    return response
+
+# Every change to a pantry's items is committed through this function. In the same transaction it increments the pantry's version,
+# which changes the ETag of the pantry's responses, and records the names of the items upserted and deleted in the pantry's change log (see /pantry/changes).
+# If the request has an If-Match header, the change is only committed if the pantry is still at the version the client read (optimistic concurrency).
+# Otherwise nothing is committed and a 412 response is returned, the client should read the pantry again before retrying.
+def commit_pantry_change(pantry_id, upserted=(), deleted=()):
+    version = Pantry.bump_version(pantry_id, if_match_versions())
+    if version is None:
+        db.session.rollback()
+        return create_response("The pantry has been changed since you last read it. Please read it again before changing it.", 412)
+    PantryChange.record(pantry_id, version, upserted, deleted)
+    db.session.commit()
+    return None
+
 # This function takes an item as input and converts it to lowercase. This ensure consistency in the database,I wanted item to be case-insensitive.
 # I needed to strip since in my delete and put/patch route items are defined in the URL. In a URL, a space is typically replaced with %20
 # Refactoring normalize_item to be the single source of item normalization ensures consistent application of rules, simplifies code maintenance, and enhances readability.
@@ -18,48 +48,244 @@ def normalize_item(item):
     normalized_item = item.lower().strip()
     return normalized_item
 
-# n this code, isinstance(items, list) checks if items is a list. If it is, the function returns a list of serialized items
-# if items is not a list, the function treats it as a single PantryItem object and returns a single serialized item.
-# This function is then used in each route to serialize the pantry items before returning them in the response. I added an extra field to serialized and return in my response.
-def serialize_pantry_items(items):
-    pantry_item_schema = PantryItemSchema()
+# The fields of a pantry item returned by the routes. A client can select some of them with the fields= query parameter of the list routes.
+# This includes run_out_time, which is returned but can't be provided by the client, so it is not part of PantryItemSchema.
+PANTRY_ITEM_FIELDS = ('item', 'used_by_date', 'count', 'run_out_time')
+
+# The fields holding a date or a datetime, serialized in ISO 8601 format ('yyyy-mm-dd' for used_by_date).
+DATE_FIELDS = ('used_by_date', 'run_out_time')
+
+# The columns selected from the database for the requested fields. The item name always comes first since the pagination cursor is built from it.
+def select_fields(fields):
+    return ('item',) + tuple(field for field in fields if field != 'item')
+
+def select_columns(fields):
+    return [getattr(PantryItem, field) for field in select_fields(fields)]
+
+# Serializing pantry items with marshmallow meant building a schema and calling dump() for every item, which dominated the CPU time of large list responses.
+# Instead the routes select only the columns they need as plain rows, and this builds a function turning one such row into the response dictionary.
+# Which position each field is at in the row is worked out once per combination of fields and cached, so serializing a row is just a dictionary build.
+# parse_list_params puts the requested fields in the order of PANTRY_ITEM_FIELDS without repeats, so there are only 15 combinations to cache.
+@lru_cache(maxsize=16)
+def get_item_serializer(fields):
+    selected = select_fields(fields)
+    plain_fields = [(field, selected.index(field)) for field in fields if field not in DATE_FIELDS]
+    date_fields = [(field, selected.index(field)) for field in fields if field in DATE_FIELDS]
+
+    def serialize(row):
+        item = {field: row[index] for field, index in plain_fields}
+        for field, index in date_fields:
+            value = row[index]
+            # run_out_time is None until the item runs out.
+            item[field] = value.isoformat() if value is not None else None
+        return item
+    return serialize
+
+# isinstance(items, list) checks if items is a list. If it is, the function returns a list of serialized items
+# if items is not a list, the function treats it as a single row and returns a single serialized item.
+# The rows must have been selected with select_columns(fields).
+@timed('serialization')
+def serialize_pantry_items(items, fields=PANTRY_ITEM_FIELDS):
+    serialize = get_item_serializer(tuple(fields))
     # Check if 'items' is a list
     if isinstance(items, list):
-        return [dict(pantry_item_schema.dump(item), extra_field='run_out_time') for item in items]
+        return [serialize(item) for item in items]
     else:
         # If 'items' is not a list, treat it as a single item
-        return dict(pantry_item_schema.dump(items), extra_field='run_out_time')
+        return serialize(items)
+
+# The cursor is the name of the last item of the previous page. It is base64 encoded so it is opaque to the client and safe to put in a URL.
+def encode_cursor(item):
+    return base64.urlsafe_b64encode(item.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    # validate=True rejects any character outside of the url safe base64 alphabet instead of silently skipping it.
+    return base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+
+# Reads the optional pagination (limit, cursor) and projection (fields) query parameters shared by the list routes.
+# It returns the parameters, or an error response if any of them is invalid.
+def parse_list_params():
+    params = {'limit': None, 'cursor': None, 'fields': PANTRY_ITEM_FIELDS}
+    max_limit = current_app.config['PANTRY_PAGE_MAX_LIMIT']
+    if 'limit' in request.args:
+        limit = parse_whole_number(request.args['limit'])
+        if limit is None or not 1 <= limit <= max_limit:
+            return None, create_response(f"limit must be a whole number between 1 and {max_limit}", 400)
+        params['limit'] = limit
+    if 'cursor' in request.args:
+        try:
+            params['cursor'] = decode_cursor(request.args['cursor'])
+        except ValueError:
+            return None, create_response("Invalid cursor. Please use the next_cursor value of the previous page", 400)
+    if 'fields' in request.args:
+        requested = {field.strip() for field in request.args['fields'].split(',') if field.strip()}
+        if not requested or not requested <= set(PANTRY_ITEM_FIELDS):
+            return None, create_response(f"fields can only contain {PANTRY_ITEM_FIELDS}", 400)
+        # Repeated or reordered fields give the same tuple, which keeps the serializer cache (see get_item_serializer) small.
+        params['fields'] = tuple(field for field in PANTRY_ITEM_FIELDS if field in requested)
+    return params, None
+
+# Runs a pantry items query for one page of results using keyset pagination.
+# Items are ordered by name, which is unique within a pantry, and each page starts after the item in the cursor.
+# Unlike an OFFSET, this is a range scan on the (pantry_id, item) index however deep the page is.
+# Only the columns of the requested fields are selected. The item name is always selected since the cursor is built from it.
+def list_pantry_items(query, params):
+    return paginate_by_item(query.with_entities(*select_columns(params['fields'])), PantryItem.item, params)
+
+# The keyset pagination shared by list_pantry_items and list_pantry_changes, 'item_column' is the item name column the query is ordered by.
+def paginate_by_item(query, item_column, params):
+    query = query.order_by(item_column)
+    if params['cursor'] is not None:
+        query = query.filter(item_column > params['cursor'])
+    limit = params['limit']
+    if limit is None:
+        return query.all(), None
+    # One extra row is fetched to know whether there is a next page without running a count query.
+    items = query.limit(limit + 1).all()
+    if len(items) > limit:
+        items = items[:limit]
+        return items, encode_cursor(items[-1].item)
+    return items, None
 
 
 @pantry_bp.route("/", methods=["GET"])
 # This route is JWT required one since user can only access their own pantry
 @jwt_required()
+# The queries of this read only route go to a read replica when one is configured.
+@read_replica
+# The response of this route has the pantry's version as its ETag and is cached per pantry (see response_cache.py).
+@cached_response
 def get_pantry():
-    #This line retrieves the current user object.
-    user = get_current_user()
-    # The 'all()' at the end returns all results of the query, which are all items in the current user's pantry.
-    pantry_items = get_user_pantry_query(user.id).all()
+    # This line reads the optional limit, cursor and fields query parameters, returning an error response if any is invalid.
+    params, response = parse_list_params()
+    if response:
+        return response
+    # This line retrieves the id of the current user's pantry from the token, without querying the users or pantries tables.
+    pantry_id = get_current_pantry_id()
+    # This returns the items in the current user's pantry, one page at a time if a limit was provided.
+    pantry_items, next_cursor = list_pantry_items(get_pantry_query(pantry_id), params)
     # This line checks if there are any items in the pantry.
     if pantry_items:
-        # If there are items, it returns a 200 status code (indicating success) nd the item details using the schema.
-         return create_response(serialize_pantry_items(pantry_items), 200)
+        # If there are items, it returns a 200 status code (indicating success) nd the item details using the schema, along with the cursor of the next page (if any).
+         return create_response(serialize_pantry_items(pantry_items, params['fields']), 200, next_cursor=next_cursor)
     # If there are no items in the pantry.
     else:
         # it returns a 200 status code and a message indicating that the pantry is empty. The route  purpose of displaying the pantry is still sucessfull hence the 200 status. 
         # It just returns an empty pantry which is correct.
         return create_response("Pantry is currently empty", 200)
 
+# The changes of a pantry since a version: the items upserted since then with their current values, and the names of the items deleted since then.
+# The item values come from pantry_items (joined on the item name) since the change log only holds the names.
+def list_pantry_changes(pantry_id, since, params):
+    columns = [PantryChange.item] + select_columns(params['fields'])[1:] + [PantryChange.deleted]
+    query = db.session.query(*columns).outerjoin(
+        PantryItem, (PantryItem.pantry_id == PantryChange.pantry_id) & (PantryItem.item == PantryChange.item)
+    ).filter(PantryChange.pantry_id == pantry_id, PantryChange.version > since)
+    return paginate_by_item(query, PantryChange.item, params)
+
+# Lets a client keep its copy of the pantry in sync by fetching only what changed since the version it has, instead of the whole pantry.
+# The response holds the items upserted since that version, the names of the items deleted since then (deleted) and the pantry's current version.
+# The client passes that version as since= on its next sync. since=0 returns the whole pantry and is how a client starts syncing.
+# Old deletions are compacted away (flask compact-changes), so a client that hasn't synced for too long gets a 410 and has to start again from since=0.
+# The limit, cursor and fields parameters work like on the other list routes. All the pages of one sync should use the version of the first page.
+@pantry_bp.route("/changes", methods=["GET"])
+# This route is JWT required one since user can only sync their own pantry
+@jwt_required()
+# The queries of this read only route go to a read replica when one is configured.
+@read_replica
+# The response of this route has the pantry's version as its ETag and is cached per pantry (see response_cache.py).
+@cached_response
+def get_pantry_changes():
+    params, response = parse_list_params()
+    if response:
+        return response
+    since = parse_whole_number(request.args.get('since', ''))
+    if since is None:
+        return create_response("since must be a whole number, the version returned by your last sync or 0 to fetch the whole pantry", 400)
+    pantry_id = get_current_pantry_id()
+    # The version is read before the changes, like in cached_response, so a change made in between is returned again on the next sync rather than missed.
+    version, changes_floor = db.session.query(Pantry.version, Pantry.changes_floor).filter(Pantry.pantry_id == pantry_id).one()
+    if 0 < since < changes_floor:
+        return create_response("Changes that old are no longer available. Please sync the whole pantry again with since=0", 410)
+    if since == 0:
+        items, next_cursor = list_pantry_items(get_pantry_query(pantry_id), params)
+        deleted = []
+    else:
+        changes, next_cursor = list_pantry_changes(pantry_id, since, params)
+        items = [change for change in changes if not change.deleted]
+        deleted = [change.item for change in changes if change.deleted]
+    return create_response(serialize_pantry_items(items, params['fields']), 200, deleted=deleted, version=version, next_cursor=next_cursor)
+
+
+# Each batch of rows becomes one chunk of the response, one JSON object per line.
+def ndjson_chunks(batches):
+    serialize = get_item_serializer(PANTRY_ITEM_FIELDS)
+    for rows in batches:
+        # The app's JSON provider is used so the export benefits from orjson when it is installed.
+        dumps = current_app.json.dumps
+        yield ''.join(dumps(serialize(row)) + '\n' for row in rows)
+
+# Each batch of rows becomes one chunk of the response, after a header line with the column names.
+# A run_out_time of None is written as an empty value.
+def csv_chunks(batches):
+    serialize = get_item_serializer(PANTRY_ITEM_FIELDS)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, PANTRY_ITEM_FIELDS)
+    writer.writeheader()
+    yield buffer.getvalue()
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(serialize(row) for row in rows)
+        yield buffer.getvalue()
+
+# Maps each supported format to the function building its chunks, its mimetype and the file extension of the download.
+EXPORT_FORMATS = {
+    'ndjson': (ndjson_chunks, 'application/x-ndjson', 'ndjson'),
+    'csv': (csv_chunks, 'text/csv', 'csv'),
+}
+
+@pantry_bp.route("/export", methods=["GET"])
+# This route is JWT required one since user can only export their own pantry
+@jwt_required()
+# The queries of this read only route go to a read replica when one is configured.
+@read_replica
+def export_pantry():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return create_response(f"format must be one of {tuple(EXPORT_FORMATS)}", 400)
+    build_chunks, mimetype, extension = EXPORT_FORMATS[export_format]
+    pantry_id = get_current_pantry_id()
+
+    # yield_per makes SQLAlchemy use a server-side cursor and fetch the rows in batches, without building ORM objects.
+    # Together with the generator below only one batch is held in memory at a time, whatever the size of the pantry.
+    statement = select(*select_columns(PANTRY_ITEM_FIELDS)).where(
+        PantryItem.pantry_id == pantry_id
+    ).order_by(PantryItem.item).execution_options(yield_per=current_app.config['PANTRY_EXPORT_BATCH_SIZE'])
+
+    def generate():
+        result = db.session.execute(statement)
+        yield from build_chunks(result.partitions())
+
+    # 'stream_with_context' keeps the request (and the database session) available while the response is being streamed, after the view has returned.
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename=pantry.{extension}'})
+
 @pantry_bp.route("/<item>", methods=["GET"])
 # This route is Jwt required one since user can only access their own pantry
 @jwt_required()
+# The queries of this read only route go to a read replica when one is configured.
+@read_replica
+# The response of this route has the pantry's version as its ETag and is cached per pantry (see response_cache.py).
+@cached_response
 def get_pantry_item(item):
-    user = get_current_user()
+    pantry_id = get_current_pantry_id()
     # This converting the input item from the route @pantry_bp.route("/<item>") to lowercase. 
     # This is done to ensure that the item names are treated in a case-insensitive manner. Since all item in our pantry are saved in a case-insentive manner
     # I wanted the retrieval to be case-insentitive too.
     normalized_item = normalize_item(item)
     # This grab the item in the user pantry that matched the item provided in the URL
-    pantry_item = get_user_pantry_query(user.id).filter(PantryItem.item == normalized_item).scalar()
+    # Only the columns that are returned are selected, as a row ready for serialize_pantry_items.
+    pantry_item = get_pantry_item_query(pantry_id, normalized_item).with_entities(*select_columns(PANTRY_ITEM_FIELDS)).first()
     # If pantry_item is not none
     if pantry_item:
         # It returns a 200 status code (indicating success) and the item details using the schema.
@@ -82,7 +308,7 @@ def post_pantry_item():
     if isinstance(data, tuple): 
         return data
 
-    user = get_current_user()
+    pantry_id = get_current_pantry_id()
 
     # if validation is sucessfull, This line normalizes the item name by converting it to lowercase. This ensures consistency in how items are stored and retrieved.
     normalized_item = normalize_item(data['item'])
@@ -91,7 +317,7 @@ def post_pantry_item():
     data['item'] = normalized_item  
 
     # this grab item in user pantry that match the provided item in json body
-    existing_item = get_user_pantry_query(user.id).filter(PantryItem.item == normalized_item).scalar()
+    existing_item = get_pantry_item_query(pantry_id, normalized_item).scalar()
     # If the item already exists in the pantry, immediately return an error response.
     if existing_item:
         return create_response("Item already exists in the pantry. Please note that item names are case-insensitive", 400)
@@ -110,18 +336,22 @@ def post_pantry_item():
 
     # This line loads the new item data into the schema . This converts the data into a format that can be used to create a new PantryItem object.
     data = schema.load(data)
-    # This line creates a new PantryItem object using the loaded data.
-    new_item = PantryItem(**data)
+    # This line converts the validated 'yyyy-mm-dd' string to a date for the used_by_date date column.
+    data['used_by_date'] = PantryItem.parse_used_by_date(data['used_by_date'])
+    # This line creates a new PantryItem object in the user's pantry using the loaded data.
+    new_item = PantryItem(pantry_id=pantry_id, **data)
     
     # This line checks if the count of the item is 0. If it is
     if data['count'] == 0:
         # the run_out_time of the item is set to the current time. 
         new_item.run_out_time = datetime.now()
 
-    # This line adds the new item to the user's pantry. 
-    user.pantry.items.append(new_item) 
+    # This line adds the new item to the database session.
+    db.session.add(new_item)
     # This line commits the changes to the database. This saves the new item in the database.
-    db.session.commit()
+    response = commit_pantry_change(pantry_id, upserted=[normalized_item])
+    if response:
+        return response
     return create_response("Item added to the pantry", 201)
 
 
@@ -129,20 +359,22 @@ def post_pantry_item():
 # This route is a jwt required one since I only want the user to be allowed to delete their own pantry item and no one else.
 @jwt_required()
 def delete_pantry_item(item):
-    user = get_current_user()
+    pantry_id = get_current_pantry_id()
 
     # I wanted the retrieval to be case-insensitive too.
     normalized_item = normalize_item(item)
 
     # This grab the item in the user pantry that matched the item provided in the URL
-    pantry_item = get_user_pantry_query(user.id).filter(PantryItem.item == normalized_item).scalar()
+    pantry_item = get_pantry_item_query(pantry_id, normalized_item).scalar()
 
     # If the item exists
     if pantry_item:
         # This line will delete it from the database.
         db.session.delete(pantry_item)
         # This line commits the changes to the database.
-        db.session.commit()
+        response = commit_pantry_change(pantry_id, deleted=[normalized_item])
+        if response:
+            return response
         # This line returns a response indicating that the item has been deleted, along with a 200 status code.
         return create_response(f"{normalized_item} has been deleted", 200)
     # If the item does not exist
@@ -161,7 +393,7 @@ def update_pantry(item):
     if isinstance(data, tuple): 
         return data
 
-    user = get_current_user()
+    pantry_id = get_current_pantry_id()
 
     # I wanted the retrieval to be case-insensitive too.
     normalized_item = normalize_item(item)
@@ -170,7 +402,7 @@ def update_pantry(item):
     updated = False
 
     # This grab the item in the user pantry that matched the item provided in the URL
-    pantry_item = get_user_pantry_query(user.id).filter(PantryItem.item == normalized_item).scalar()
+    pantry_item = get_pantry_item_query(pantry_id, normalized_item).scalar()
     # This line checks if pantry_item returned None. 
     if pantry_item is None:
         # This line returns a response indicating that the item doesn't exist in the database, along with a 404 status code.
@@ -188,13 +420,15 @@ def update_pantry(item):
 
     # This line checks if 'used_by_date' is a key in the request (inputted) data.
     if 'used_by_date' in data:
+        # The stored used_by_date is a date, so the validated string is converted before comparing them.
+        used_by_date = PantryItem.parse_used_by_date(data['used_by_date'])
          # this line calls the check_no_change function to see if the new used_by_date is different from the current one.
          # If they are the same, check_no_change will return a response indicating that no update is needed, and this response will be immediately returned to the client.
-        response = check_no_change(pantry_item.used_by_date, data['used_by_date'], f"{normalized_item} could not update used_by_date because the data is the same")
+        response = check_no_change(pantry_item.used_by_date, used_by_date, f"{normalized_item} could not update used_by_date because the data is the same")
         if response:
             return response
         # If the used_by_date in the request data is different from the current one, this line updates the pantry item's used_by_date with the new date.
-        pantry_item.used_by_date = data['used_by_date']
+        pantry_item.used_by_date = used_by_date
         updated = True
 
 
@@ -223,7 +457,9 @@ def update_pantry(item):
     # if update has been set to True at any point in the code 
     if updated is True:
         # Commit all the change(s)
-        db.session.commit()
+        response = commit_pantry_change(pantry_id, upserted=[normalized_item])
+        if response:
+            return response
         return create_response(f"{normalized_item} has been updated", 200)
     else:
         return create_response("No update since no amendment has been provided for either count or used_by_date or both", 400)
@@ -233,15 +469,22 @@ def update_pantry(item):
 @pantry_bp.route("/itemrunout", methods=["GET"])
 # This route is a jwt required one since I only want the user to be allowed to grab the items in their pantry that have ran out of stock.
 @jwt_required()
+# The queries of this read only route go to a read replica when one is configured.
+@read_replica
+# The response of this route has the pantry's version as its ETag and is cached per pantry (see response_cache.py).
+@cached_response
 def get_runout_items():
-    user = get_current_user()
+    params, response = parse_list_params()
+    if response:
+        return response
+    pantry_id = get_current_pantry_id()
     # This line queries the database directly for items in the user's pantry where the count is 0.
-    runout_items = get_user_pantry_query(user.id).filter(PantryItem.count == 0).all()
+    runout_items, next_cursor = list_pantry_items(get_pantry_query(pantry_id).filter(PantryItem.count == 0), params)
     # This line checks if the runout_items return is not empty, which means there are out of stock items.
     if runout_items:
             # If there are out of stock items, this line returns a response with
             # a list of these items, along with a 200 status code.
-        return create_response(serialize_pantry_items(runout_items), 200)
+        return create_response(serialize_pantry_items(runout_items, params['fields']), 200, next_cursor=next_cursor)
         # If there are no out of stock items (i.e., the runout_items list is empty), 
         # this line returns a response indicating that there are no out of stock items, along with a 200 status code.
     else:
@@ -255,22 +498,30 @@ def get_runout_items():
 @pantry_bp.route("/itemusedby/<int:days>", methods=["GET"])
 # This route is a jwt required one since I only want the user to be allowed to grab the items in their pantry that need to be used within a certain number of days.
 @jwt_required()
+# The queries of this read only route go to a read replica when one is configured.
+@read_replica
+# The response of this route has the pantry's version as its ETag and is cached per pantry (see response_cache.py).
+@cached_response
 def get_items_used_by(days):
-    user = get_current_user()
+    params, response = parse_list_params()
+    if response:
+        return response
+    pantry_id = get_current_pantry_id()
     # Get the current date
     now = datetime.now().date()
     # Calculate the future date by adding the specified number of days to the current date
     # When this timedelta is added to 'now', it results in a new date that is 'x' amount of days in the future
     future = now + timedelta(days=days)
 
-    # filters for items that need to be used between now and the future date
-    items_to_use = get_user_pantry_query(user.id).filter(
-        cast(PantryItem.used_by_date, Date) >= now,
-        cast(PantryItem.used_by_date, Date) <= future
-    ).all()
+    # filters for items that need to be used between now and the future date.
+    # used_by_date is a date column so this is a range scan on the (pantry_id, used_by_date) index.
+    items_to_use, next_cursor = list_pantry_items(get_pantry_query(pantry_id).filter(
+        PantryItem.used_by_date >= now,
+        PantryItem.used_by_date <= future
+    ), params)
      # If there are items to use, return them in the response
     if items_to_use:
-        return create_response(serialize_pantry_items(items_to_use), 200)
+        return create_response(serialize_pantry_items(items_to_use, params['fields']), 200, next_cursor=next_cursor)
     else:
         return create_response(f"You have no items to be used in the next {days} days", 200)
 
@@ -278,15 +529,130 @@ def get_items_used_by(days):
 @pantry_bp.route("/itemexpired", methods=["GET"])
 # This route is a jwt required one since I only want the user to be allowed to grab the items in their pantry that have expired.
 @jwt_required()
+# The queries of this read only route go to a read replica when one is configured.
+@read_replica
+# The response of this route has the pantry's version as its ETag and is cached per pantry (see response_cache.py).
+@cached_response
 def get_expired_items():
-    user = get_current_user()
+    params, response = parse_list_params()
+    if response:
+        return response
+    pantry_id = get_current_pantry_id()
     now = datetime.now().date()
     # filters for items that have expired and therefore is less (passed) than the current date
-    expired_items = get_user_pantry_query(user.id).filter(
-        cast(PantryItem.used_by_date, Date) < now
-    ).all()
+    expired_items, next_cursor = list_pantry_items(get_pantry_query(pantry_id).filter(
+        PantryItem.used_by_date < now
+    ), params)
      # If there are expired items, return them in the response
     if expired_items:
-        return create_response(serialize_pantry_items(expired_items), 200)
+        return create_response(serialize_pantry_items(expired_items, params['fields']), 200, next_cursor=next_cursor)
     else:
-        return create_response("You have no expired items", 200)
\ No newline at end of file
+        return create_response("You have no expired items", 200)
+
+
+# The schema each bulk operation is validated against, based on its 'op' field.
+BULK_OPERATION_SCHEMAS = {
+    'upsert': PantryItemSchema,
+    'delete': DeletePantryItemSchema,
+}
+
+# Validates one bulk operation the same way the single item routes validate their data: first against the schema, then against the staticmethods.
+# Returns the normalized data, or a dictionary of errors if the operation is invalid.
+def validate_bulk_operation(operation):
+    if not isinstance(operation, dict):
+        return None, {'error': 'Each operation must be a JSON object.'}
+    op = operation.get('op')
+    if op not in BULK_OPERATION_SCHEMAS:
+        return None, {'op': f"op must be one of {tuple(BULK_OPERATION_SCHEMAS)}"}
+    schema = BULK_OPERATION_SCHEMAS[op]()
+    # The 'op' field itself is not part of the item data.
+    data = {key: value for key, value in operation.items() if key != 'op'}
+    errors = schema.validate(data)
+    if errors:
+        return None, errors
+    data['item'] = normalize_item(data['item'])
+    errors = get_field_errors(prepare_data_dict(data, schema.fields.keys(), PantryItem))
+    if errors:
+        return None, errors
+    data['op'] = op
+    return data, None
+
+@pantry_bp.route("/items/bulk", methods=["POST"])
+# This route is a jwt required one since I only want the user to be allowed to change their own pantry items.
+@jwt_required()
+def bulk_pantry_items():
+    # The body is a JSON array of operations such as {"op": "upsert", "item": ..., "used_by_date": ..., "count": ...} or {"op": "delete", "item": ...}.
+    # It lets clients such as grocery imports change hundreds of items in one request, one insert statement, one delete statement and one commit,
+    # instead of one request, one existence check and one commit per item.
+    operations = load_json_list(request)
+    if isinstance(operations, tuple):
+        return operations
+    if not operations:
+        return create_response("No operations provided", 400)
+    max_operations = current_app.config['PANTRY_BULK_MAX_OPERATIONS']
+    if len(operations) > max_operations:
+        return create_response(f"A maximum of {max_operations} operations can be sent in one request", 400)
+
+    upserts = {}
+    deletes = set()
+    # Errors are collected for every operation (keyed by its position in the array) so the client can fix them all at once.
+    errors = {}
+    for index, operation in enumerate(operations):
+        data, operation_errors = validate_bulk_operation(operation)
+        if operation_errors:
+            errors[index] = operation_errors
+        # An item can only be changed once per request, otherwise the result would depend on the order of the operations.
+        elif data['item'] in upserts or data['item'] in deletes:
+            errors[index] = {'item': f"{data['item']} appears in more than one operation"}
+        elif data['op'] == 'upsert':
+            upserts[data['item']] = data
+        else:
+            deletes.add(data['item'])
+
+    # Nothing is changed if any operation is invalid, so the client never has to work out which operations were applied.
+    if errors:
+        return create_response("No changes were made because some operations are invalid", 400, errors=errors)
+
+    pantry_id = get_current_pantry_id()
+    now = datetime.now()
+    upserted = 0
+    if upserts:
+        rows = [
+            {
+                'pantry_id': pantry_id,
+                'item': data['item'],
+                'used_by_date': PantryItem.parse_used_by_date(data['used_by_date']),
+                'count': data['count'],
+                'run_out_time': now if data['count'] == 0 else None,
+            }
+            for data in upserts.values()
+        ]
+        # One multi-row INSERT ... ON CONFLICT. New items are inserted, existing items (matched by the unique (pantry_id, item) index) are updated.
+        statement = insert(PantryItem).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[PantryItem.pantry_id, PantryItem.item],
+            set_={
+                'used_by_date': statement.excluded.used_by_date,
+                'count': statement.excluded.count,
+                # Same rules as the update route: restocking resets run_out_time, and an item that had already run out keeps its original run_out_time.
+                'run_out_time': case(
+                    (statement.excluded.count > 0, None),
+                    (PantryItem.count == 0, PantryItem.run_out_time),
+                    else_=statement.excluded.run_out_time,
+                ),
+            },
+        )
+        upserted = db.session.execute(statement).rowcount
+
+    not_found = []
+    deleted = set()
+    if deletes:
+        # One DELETE for all the items, returning the names of the items that actually existed.
+        statement = delete(PantryItem).where(PantryItem.pantry_id == pantry_id, PantryItem.item.in_(deletes)).returning(PantryItem.item)
+        deleted = set(db.session.execute(statement).scalars())
+        not_found = sorted(deletes - deleted)
+
+    response = commit_pantry_change(pantry_id, upserted=upserts.keys(), deleted=deleted)
+    if response:
+        return response
+    return create_response("Bulk operation completed", 200, upserted=upserted, deleted=len(deletes) - len(not_found), not_found=not_found)
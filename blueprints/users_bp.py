@@ -1,11 +1,13 @@
 from flask import Blueprint, request
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, get_jwt
-from datetime import timedelta
+from datetime import timedelta, datetime, timezone
+from sqlalchemy.exc import IntegrityError
 from models.user import User
 from models.authorization import RegisterSchema, LoginSchema, RevokedToken,ForgetPasswordSchema,ResetPasswordSchema,SecurityAnswerSchema
-from utils import validate_data, check_field, prepare_data_dict, validate_fields, create_response, get_model_by_field, check_match
+from utils import validate_data, check_fields, prepare_data_dict, validate_fields, create_response, get_model_by_field, check_match
 from setup import db
 from jwt_config import get_current_user
+from token_cache import revoked_token_cache
 
 # 'url_prefix' is a path to prepend to all URLs associated with the Blueprint.
 users_bp = Blueprint('users', __name__, url_prefix='/users')
@@ -17,6 +19,13 @@ def process_and_normalize_data(data, fields):
     case_sensitive_fields = ['password', 'old_password', 'new_password', 'confirm_password']
     return {field: data[field] if field in case_sensitive_fields else data[field].lower() for field in fields}
 
+# The fields that must be unique among users, with the error message returned when a value is already taken.
+def unique_field_checks(processed_data):
+    return [
+        ('username', processed_data['username'], 'Username already taken. Please note that username are case-insentitive'),
+        ('email', processed_data['email'], 'Email already taken'),
+    ]
+
 @users_bp.route("/register", methods=["POST"])
 def register():
     # Create a new instance of the RegisterSchema. The schema is used to validate the incoming request data against.
@@ -33,16 +42,6 @@ def register():
     # Process and normalize the data. This function converts all field values to lowercase, except for certain fields like passwords.
     processed_data = process_and_normalize_data(data, fields)
 
-    # Check if the username already exists in the database. If it does, return an error response and the rest of the code will not be executed.
-    response = check_field(User, 'username', processed_data['username'], 'Username already taken. Please note that username are case-insentitive')
-    if response:
-        return response
-
-    # Check if the email already exists in the database. If it does, return an error response and the rest of the code will not be executed.
-    response = check_field(User, 'email', processed_data['email'], 'Email already taken')
-    if response:
-        return response
-
     # Prepare the keys into data dictionary for validation against staticmethod.
     data_dict = prepare_data_dict(data, fields, User)
 
@@ -52,6 +51,12 @@ def register():
     if response:
         return response
 
+    # Check if the username or email is already taken, with a single query, before paying for the two hashes below.
+    # This is only a shortcut for the common case of a retried signup: the unique constraints remain what guarantees uniqueness (see below).
+    response = check_fields(User, unique_field_checks(processed_data))
+    if response:
+        return response
+
     # Create a new User instance with the processed data and validated data. Harcoding the security question, meaning all users will have the same security question.
     user = User(username=processed_data['username'], email=processed_data['email'], security_question="What is your favourite childhood book")
   
@@ -59,10 +64,20 @@ def register():
     user.set_password(processed_data['password'])
     user.set_security_answer(processed_data['security_answer'])
 
-    # Add the new User instance to the database session. This stages the user for insertion into the database.
-    db.session.add(user)
-    # Commit the database session. This inserts the user into the database.
-    db.session.commit()
+    # Insert the user along with their pantry, in a single statement on PostgreSQL. Since I want all users to have one pantry it made sense to create it at the same time.
+    # The unique constraints of the users table reject a username or email taken since the check above,
+    # e.g. when two people register the same username at the same time, which a lookup followed by an insert can't prevent.
+    try:
+        User.create_with_pantries([{column: getattr(user, column) for column in ('username', 'email', 'security_question', 'password_hash', 'security_answer')}])
+        # Commit the database session. This makes the user and their pantry permanent.
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # Find out which of the fields was taken, with a single query, to return its error message.
+        response = check_fields(User, unique_field_checks(processed_data))
+        if response:
+            return response
+        raise
     # Return a success response.
     return create_response('User registered successfully', 201, user={'username': processed_data['username'], 'email': processed_data['email']})
 
@@ -85,11 +100,15 @@ def login():
     if response:
         return response
 
+    # Now that the password is known to be correct, rehash it in the background if the stored hash uses outdated hashing settings.
+    user.upgrade_hash('password_hash', processed_data['password'])
+
     # This line is creating a timedelta object that represents a duration of time. In this case, it’s being set to a duration of 1 hour
     expires = timedelta(hours=1)
     # This line is creating an access token for the user as a login is successful. The expires_delta argument is being set to the expires timedelta object created earlier.
     # This means the token will expire 1 hour after being issued.
-    access_token = create_access_token(identity=user.id, expires_delta=expires)
+    # The id of the user's pantry is added as a claim to the token so the pantry routes can use it directly without querying the user on every request.
+    access_token = create_access_token(identity=user.id, expires_delta=expires, additional_claims={'pantry_id': user.pantry.pantry_id})
     response, status_code = create_response(f'Login successful with {processed_data["username"]}', 200, access_token=access_token)
     # This line is adding the access token to the Authorization header in the response. 
     # Even though in the above line I already return the token in the response body it is common practice to also return it in the Authorization header.
@@ -102,10 +121,14 @@ def login():
 def logout():
     # Get the JTI for the current token
     jti = get_jwt()["jti"]  
+    # Get the expiry of the current token, stored alongside the JTI so the row can be purged once the token would have expired anyway.
+    expires_at = datetime.fromtimestamp(get_jwt()["exp"], timezone.utc)
     # Create a new RevokedToken object with the JTI of the current token
-    revoked_token = RevokedToken(jti=jti)
+    revoked_token = RevokedToken(jti=jti, expires_at=expires_at)
     # Add the revoked token to the database so that once user log out, they cannot access protected routes with their revoked token.
     revoked_token.add()
+    # Also add it to this worker's revoked token cache, along with the token's expiry so the cache can forget it once it has expired anyway.
+    revoked_token_cache.add(jti, get_jwt()["exp"])
     # Get the username of the current JTI
     username = get_jwt_identity()
     if username:
@@ -135,6 +158,9 @@ def forget_password():
         # This stops the execution of the rest of the code, effectively preventing the the reset of password due to failed identity verification.
         return create_response('Invalid username or security answer', 401)
 
+    # Now that the security answer is known to be correct, rehash it in the background if the stored hash uses outdated hashing settings.
+    user.upgrade_hash('security_answer', processed_data['security_answer'])
+
     # Note that I am doing the staticmethod validations after the code is making sure that user exist and have sucessfully provided their security answer.
     # This avoid unecessary computations.
     data_dict = prepare_data_dict(processed_data, fields, User)
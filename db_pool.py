@@ -0,0 +1,54 @@
+import time
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+from metrics import Histogram
+
+
+# A QueuePool that records how long each checkout takes (waiting for a free connection, opening a new one and the pre-ping)
+# and how many checkouts timed out. Together with the pool's own counts these are exposed by the /metrics route,
+# since waiting on the pool is otherwise invisible and shows up as unexplained latency.
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_wait = Histogram()
+        self.checkout_timeouts = 0
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            self.checkout_wait.observe(time.perf_counter() - start)
+
+
+# Builds the SQLAlchemy engine options from the DB_* settings of the app config.
+# - DB_POOL_SIZE connections are kept open per process, and up to DB_MAX_OVERFLOW more are opened under load.
+#   With several server processes, the total (processes x (size + overflow)) must stay under PostgreSQL's max_connections.
+# - DB_POOL_TIMEOUT is how long a request waits for a free connection before failing.
+# - DB_POOL_RECYCLE replaces connections older than this many seconds, before the database or a firewall drops them.
+# - DB_POOL_PRE_PING checks a connection is still alive before handing it out.
+# - DB_EXTERNAL_POOLER is for running behind an external pooler such as pgbouncer. The app then doesn't pool connections itself
+#   (NullPool) and leaves that to the pooler.
+# - DB_STATEMENT_TIMEOUT_MS makes PostgreSQL cancel any statement running longer than this. pgbouncer doesn't pass this startup option on,
+#   so with an external pooler set statement_timeout on the database role instead.
+def engine_options(config):
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    options = {}
+    if uri.startswith('postgresql') and config['DB_STATEMENT_TIMEOUT_MS']:
+        options['connect_args'] = {'options': f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"}
+    if config['DB_EXTERNAL_POOLER']:
+        options['poolclass'] = NullPool
+    # SQLite (only used as a local stand-in) picks its own pool class, which doesn't take these settings.
+    elif not uri.startswith('sqlite'):
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=config['DB_POOL_SIZE'],
+            max_overflow=config['DB_MAX_OVERFLOW'],
+            pool_timeout=config['DB_POOL_TIMEOUT'],
+            pool_recycle=config['DB_POOL_RECYCLE'],
+            pool_pre_ping=config['DB_POOL_PRE_PING'],
+        )
+    return options
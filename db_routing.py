@@ -0,0 +1,134 @@
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context, request
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy.exc import OperationalError
+
+
+# The bind keys of the read replicas in SQLALCHEMY_BINDS are 'replica_0', 'replica_1', ...
+def replica_binds(urls):
+    return {f'replica_{index}': url for index, url in enumerate(urls)}
+
+
+# The cookie (and header) carrying the time until which the client's reads must go to the primary, as a Unix timestamp.
+STICKY_COOKIE = 'read_primary_until'
+STICKY_HEADER = 'X-Read-Primary-Until'
+
+
+# Chooses which read replica serves a read only request.
+# - Replicas are used in turn (round robin), skipping any replica that failed recently until DB_REPLICA_COOLDOWN_SECONDS have passed.
+# - A replica can lag behind the primary, so for DB_REPLICA_STICKY_SECONDS after a user has changed their data, that user's reads stay on the primary.
+#   The server processes don't share memory, so the end of that window is sent back to the client with the response to the change,
+#   in a cookie and an X-Read-Primary-Until header (see sticky_response). A client that returns either one reads its own writes whichever process
+#   serves it. The window is also remembered by the process that handled the change, which covers clients that return neither only
+#   when their next read lands on the same process.
+class ReplicaRouter:
+    def __init__(self):
+        self.replicas = []
+        self.next_index = 0
+        self.down_until = {}
+        self.last_writes = {}
+        self.sticky_seconds = 5
+        self.cooldown_seconds = 30
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        # The router is shared by the process (see create_app), so the state of an app built before this one is dropped.
+        with self.lock:
+            self.next_index = 0
+            self.down_until = {}
+            self.last_writes = {}
+        self.replicas = sorted(key for key in app.config.get('SQLALCHEMY_BINDS', {}) if key.startswith('replica_'))
+        self.sticky_seconds = app.config.get('DB_REPLICA_STICKY_SECONDS', self.sticky_seconds)
+        self.cooldown_seconds = app.config.get('DB_REPLICA_COOLDOWN_SECONDS', self.cooldown_seconds)
+
+    # Returns the bind key of the replica to read from, or None to read from the primary.
+    # 'client_until' is the end of the sticky window sent back by the client, if any.
+    def choose(self, user_key, client_until=None):
+        if not self.replicas:
+            return None
+        # Wall clock time, since the window sent to the client is compared by other processes (and possibly other servers).
+        now = time.time()
+        if client_until is not None and client_until > now:
+            return None
+        with self.lock:
+            if self.last_writes.get(user_key, 0) > now:
+                return None
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[self.next_index % len(self.replicas)]
+                self.next_index += 1
+                if self.down_until.get(replica, 0) <= now:
+                    return replica
+        # Every replica is down, fall back to the primary.
+        return None
+
+    def mark_down(self, replica):
+        with self.lock:
+            self.down_until[replica] = time.time() + self.cooldown_seconds
+
+    # Records a change made by a user and returns the end of their sticky window, to be sent to the client.
+    def record_write(self, user_key):
+        now = time.time()
+        until = now + self.sticky_seconds
+        with self.lock:
+            self.last_writes[user_key] = until
+            # Forget the windows that are over now and then, so the dictionary doesn't keep every user that ever wrote.
+            if len(self.last_writes) > 10000:
+                self.last_writes = {key: until for key, until in self.last_writes.items() if until > now}
+        return until
+
+    # Records a change made by a user and adds the end of their sticky window to the response. Only needed when there are replicas.
+    def sticky_response(self, user_key, response):
+        if not self.replicas:
+            return response
+        until = self.record_write(user_key)
+        response.set_cookie(STICKY_COOKIE, f'{until:.3f}', max_age=int(self.sticky_seconds) + 1, httponly=True, samesite='Lax')
+        response.headers[STICKY_HEADER] = f'{until:.3f}'
+        return response
+
+
+# The end of the sticky window sent back by the client, from the header or the cookie. A missing or malformed value is ignored.
+# A client can only use it to send its own reads to the primary.
+def client_sticky_until():
+    value = request.headers.get(STICKY_HEADER) or request.cookies.get(STICKY_COOKIE)
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+replica_router = ReplicaRouter()
+
+
+# The database session used by the app. It behaves exactly like Flask-SQLAlchemy's session,
+# except that while a read only route is running (see read_replica below) queries go to the chosen read replica.
+# Anything flushed (inserts, updates, deletes) still goes to the primary.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            replica = g.get('db_replica')
+            if replica is not None:
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# Decorator for read only routes. It must be placed under @jwt_required() so the token (and the blocklist) is checked against the primary first.
+# The route's queries are sent to a read replica chosen by the router. If the replica can't be reached, it is marked as down
+# and the route is run again against the primary, so a failing replica doesn't fail the request.
+def read_replica(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        replica = replica_router.choose(get_jwt_identity(), client_sticky_until())
+        if replica is None:
+            return view(*args, **kwargs)
+        g.db_replica = replica
+        try:
+            return view(*args, **kwargs)
+        except OperationalError:
+            replica_router.mark_down(replica)
+            current_app.extensions['sqlalchemy'].session.rollback()
+            g.db_replica = None
+            return view(*args, **kwargs)
+    return wrapper
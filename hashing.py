@@ -0,0 +1,161 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import bcrypt
+from flask import g, has_request_context
+from profiling import timed
+
+# argon2-cffi is an optional dependency, only needed when PASSWORD_HASH_SCHEME is 'argon2' or when argon2 hashes are stored.
+try:
+    from argon2 import PasswordHasher as Argon2Hasher
+    from argon2.exceptions import VerificationError, InvalidHashError
+except ImportError:
+    Argon2Hasher = None
+
+# The schemes new hashes can be generated with.
+SCHEMES = ('bcrypt', 'argon2')
+
+
+# These functions do the actual hashing work. They are module level functions (not methods) so they can be sent to the worker processes of the pool.
+# 'params' is the bcrypt work factor for bcrypt, and (time cost, memory cost, parallelism) for argon2.
+def _generate_hash(original, scheme, params):
+    if scheme == 'argon2':
+        time_cost, memory_cost, parallelism = params
+        return Argon2Hasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism).hash(original)
+    return bcrypt.hashpw(original.encode('utf-8'), bcrypt.gensalt(params)).decode('utf-8')
+
+# The scheme a hash was generated with is recognised from its prefix, so users with hashes from different schemes can all log in.
+def _check_hash(hashed, original):
+    if hashed.startswith('$argon2'):
+        if Argon2Hasher is None:
+            raise RuntimeError('argon2-cffi must be installed to check argon2 hashes')
+        try:
+            return Argon2Hasher().verify(hashed, original)
+        except (VerificationError, InvalidHashError):
+            return False
+    return bcrypt.checkpw(original.encode('utf-8'), hashed.encode('utf-8'))
+
+# Returns the scheme and parameters a hash was generated with, e.g. 'bcrypt$12' or 'argon2id$m=65536,t=3,p=4'.
+# Two hashes with the same version were generated with the same settings.
+# bcrypt hashes look like '$2b$12$<salt and hash>' and argon2 hashes like '$argon2id$v=19$m=65536,t=3,p=4$<salt>$<hash>'.
+def hash_version(hashed):
+    parts = hashed.split('$')
+    if hashed.startswith('$argon2') and len(parts) > 4:
+        return f'{parts[1]}${parts[3]}'
+    if hashed.startswith('$2') and len(parts) > 3:
+        return f'bcrypt${int(parts[2])}'
+    return 'unknown'
+
+
+# This class is the single place passwords and security answers are hashed and checked.
+# - The scheme of new hashes is configurable with PASSWORD_HASH_SCHEME, bcrypt (default) or argon2, along with its cost:
+#   BCRYPT_LOG_ROUNDS for bcrypt (each extra round doubles the time a hash takes), ARGON2_TIME_COST, ARGON2_MEMORY_COST and ARGON2_PARALLELISM for argon2.
+# - With PASSWORD_HASH_WORKERS set, hashing runs in a bounded pool of worker processes so CPU bound hashing can use every core,
+#   instead of competing with the request threads of the web worker for its CPU.
+# - The result of a check is remembered for the rest of the request, so checking the same value against the same hash twice only hashes once.
+# - Hashes generated with other settings than the current ones can be rehashed in the background after a successful check (see rehash_later),
+#   which migrates users to new settings as they log in, without forcing password resets.
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.app = None
+        self.pool = None
+        self.pool_pid = None
+        self.rehash_executor = None
+        self.rehash_pid = None
+        self.rehash_slots = threading.BoundedSemaphore(100)
+        self.lock = threading.Lock()
+        self.configure(12, 0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        scheme = app.config.get('PASSWORD_HASH_SCHEME', 'bcrypt')
+        if scheme == 'argon2':
+            params = (app.config.get('ARGON2_TIME_COST', 3), app.config.get('ARGON2_MEMORY_COST', 65536), app.config.get('ARGON2_PARALLELISM', 4))
+        else:
+            params = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.configure(params, app.config.get('PASSWORD_HASH_WORKERS', 0), scheme)
+        # At most this many rehashes wait in the background at once. Others are skipped, the user is simply rehashed on a later login.
+        self.rehash_slots = threading.BoundedSemaphore(app.config.get('PASSWORD_REHASH_QUEUE', 100))
+
+    def configure(self, params, workers, scheme='bcrypt'):
+        if scheme not in SCHEMES:
+            raise ValueError(f'PASSWORD_HASH_SCHEME must be one of {SCHEMES}')
+        if scheme == 'argon2' and Argon2Hasher is None:
+            raise RuntimeError('argon2-cffi must be installed to use the argon2 password hash scheme')
+        self.scheme = scheme
+        self.params = params
+        self.workers = workers
+        # At most two hashes per worker process are queued at once. Any other request waits for a slot instead of piling up work in the pool's queue.
+        self.slots = threading.BoundedSemaphore(self.workers * 2) if self.workers else None
+        # A pool started with the previous settings is replaced on next use.
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+        # The version (see hash_version) of the hashes generated with these settings.
+        if scheme == 'argon2':
+            time_cost, memory_cost, parallelism = params
+            self.current_version = f'argon2id$m={memory_cost},t={time_cost},p={parallelism}'
+        else:
+            self.current_version = f'bcrypt${params}'
+
+    # The pool is created on first use, in the process that uses it. A pool created before the web server forks its workers
+    # would be shared by all of them, so if the process id has changed since the pool was created a new one is started.
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+                self.pool_pid = os.getpid()
+            return self.pool
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        with self.slots:
+            return self._get_pool().submit(function, *args).result()
+
+    @timed('hashing')
+    def generate_hash(self, original):
+        return self._run(_generate_hash, original, self.scheme, self.params)
+
+    @timed('hashing')
+    def check_hash(self, hashed, original):
+        if not has_request_context():
+            return self._run(_check_hash, hashed, original)
+        # The checks already done in this request, stored on 'g' so they are forgotten at the end of the request.
+        checked = g.setdefault('checked_hashes', {})
+        key = (hashed, original)
+        if key not in checked:
+            checked[key] = self._run(_check_hash, hashed, original)
+        return checked[key]
+
+    # A hash needs rehashing if it wasn't generated with the current scheme and cost.
+    def needs_rehash(self, hashed):
+        return hash_version(hashed) != self.current_version
+
+    # Generates a new hash of 'original' with the current settings on a background thread, then calls save(new_hash) in an application context.
+    # This must only be called once 'original' has been checked against the stored hash, since that is the only time the original is known.
+    def rehash_later(self, original, save):
+        # Skip the rehash if too many are already waiting, rather than building an unbounded backlog.
+        if not self.rehash_slots.acquire(blocking=False):
+            return
+        slots = self.rehash_slots
+
+        def rehash():
+            try:
+                new_hash = self.generate_hash(original)
+                with self.app.app_context():
+                    save(new_hash)
+            except Exception:
+                # A failed rehash is not fatal, the old hash still works and the user is rehashed on a later login.
+                self.app.logger.exception('Rehashing a password hash in the background failed')
+            finally:
+                slots.release()
+
+        with self.lock:
+            # Like the process pool, the thread is created in the process that uses it.
+            if self.rehash_executor is None or self.rehash_pid != os.getpid():
+                self.rehash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='password-rehash')
+                self.rehash_pid = os.getpid()
+            self.rehash_executor.submit(rehash)
@@ -0,0 +1,47 @@
+from flask.json.provider import DefaultJSONProvider
+
+# orjson is an optional dependency. It encodes JSON several times faster than the standard library json module, straight to bytes.
+# If it isn't installed the provider below behaves exactly like Flask's default provider.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Flask uses its JSON provider for jsonify (and therefore create_response) and for parsing JSON.
+# This provider uses orjson when it is available. Anything orjson doesn't support (for example the keyword arguments of json.dumps,
+# or the indented output of debug mode) goes through the default standard library implementation.
+class FastJSONProvider(DefaultJSONProvider):
+    # Non ASCII characters (e.g. in item names) are written as UTF-8 instead of \u escapes. Both are valid JSON for the same data.
+    ensure_ascii = False
+
+    # The orjson options matching the default provider's output:
+    # - OPT_NON_STR_KEYS allows non string keys such as the operation indexes of the bulk route's errors.
+    # - OPT_PASSTHROUGH_DATETIME hands dates and datetimes to 'default', so they are formatted the same way as the default provider does.
+    def _orjson_options(self):
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def _use_orjson(self, kwargs):
+        # orjson always escapes to UTF-8 so it is only used when ASCII output hasn't been asked for.
+        return orjson is not None and not kwargs and not self.ensure_ascii
+
+    def dumps(self, obj, **kwargs):
+        if self._use_orjson(kwargs):
+            return orjson.dumps(obj, default=self.default, option=self._orjson_options()).decode('utf-8')
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        if orjson is None or pretty or self.ensure_ascii:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        # The encoded bytes are used as the body as is, skipping the decode to str and encode back to bytes.
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self._orjson_options()) + b"\n", mimetype=self.mimetype)
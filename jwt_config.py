@@ -1,7 +1,11 @@
-from flask_jwt_extended import JWTManager, get_jwt_identity
-from models.authorization import RevokedToken
+from flask import g
+from flask_jwt_extended import JWTManager, get_jwt_identity, get_jwt
+from token_cache import revoked_token_cache
 from utils import create_response
 from models.user import User 
+from models.pantry import Pantry
+from setup import db
+from profiling import timed
 
 jwt = JWTManager()
 
@@ -9,9 +13,11 @@ jwt = JWTManager()
 # It's decorated with 'jwt.token_in_blocklist_loader', which means it's used to check if a JWT token is in a blocklist (or "blacklist").
 # If my route have the @jwt_required() decorator it will automatically call the function decorated with @jwt.token_in_blocklist_loader to check if the token is in the blacklist.
 @jwt.token_in_blocklist_loader
+# The lookup goes through the revoked token cache first, which only queries the database when its bloom filter can't rule the jti out.
+@timed('blocklist')
 def check_if_token_in_blacklist(jwt_header, jwt_payload):
     jti = jwt_payload["jti"]
-    return RevokedToken.is_jti_blacklisted(jti)
+    return revoked_token_cache.is_revoked(jti, jwt_payload["exp"])
 
 @jwt.revoked_token_loader
 def revoked_token_callback(jwt_header, jwt_payload):
@@ -35,4 +41,17 @@ def get_current_user():
     current_user_id = get_jwt_identity()
     # 'User.query.get(current_user_id)' is a SQLAlchemy query that retrieves a User object with the specified ID from the database.
     # It returns the User object if it exists, or 'None' if no such user exists.
-    return User.query.get(current_user_id)
\ No newline at end of file
+    return User.query.get(current_user_id)
+
+# This function retrieves the id of the current user's pantry.
+# The pantry id is added as a claim to the token at login, so for the pantry routes there is no need to load the User row or join through it on every request.
+def get_current_pantry_id():
+    # 'get_jwt()' returns the claims of the token in the current request.
+    pantry_id = get_jwt().get('pantry_id')
+    if pantry_id is not None:
+        return pantry_id
+    # Tokens issued before the claim was added don't have it, so fall back to a single lookup on pantries.user_id.
+    # The result is kept on 'g' so it is only looked up once per request.
+    if 'pantry_id' not in g:
+        g.pantry_id = db.session.query(Pantry.pantry_id).filter(Pantry.user_id == get_jwt_identity()).scalar()
+    return g.pantry_id
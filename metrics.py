@@ -0,0 +1,48 @@
+import threading
+
+# The default upper bounds (in seconds) of the histogram buckets, from 1 millisecond to 10 seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# A histogram in the Prometheus sense: how many observations fell at or under each bucket's upper bound, with their count and sum.
+# It is cheap enough to record on every request and is rendered in the Prometheus text format by render_histogram.
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            # Only the first bucket the value fits in is incremented. The counts are made cumulative when rendering.
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+
+# Formats labels as {name="value",...}. Backslashes, quotes and new lines in the values are escaped as the text format requires.
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def render_histogram(name, histogram, labels=None):
+    labels = labels or {}
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{format_labels({**labels, "le": bound})} {cumulative}')
+    lines.append(f'{name}_bucket{format_labels({**labels, "le": "+Inf"})} {histogram.count}')
+    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+    return lines
+
+def render_sample(name, value, labels=None):
+    return f'{name}{format_labels(labels)} {value}'
@@ -1,4 +1,6 @@
 from marshmallow import fields, INCLUDE
+from datetime import datetime, timezone
+from sqlalchemy import select
 from setup import db
 from .base_schema import BaseSchema
 
@@ -8,7 +10,11 @@ from .base_schema import BaseSchema
 class RevokedToken(db.Model):
     __tablename__ = 'revoked_tokens'
     id = db.Column(db.Integer, primary_key=True)
-    jti = db.Column(db.String(120))
+    # The unique index turns the is_jti_blacklisted lookup into an index lookup instead of a sequential scan of every logout ever made.
+    jti = db.Column(db.String(120), unique=True, index=True, nullable=False)
+    # The 'exp' of the revoked token. Once that time has passed the token is rejected as expired anyway, so the row is no longer needed and can be purged.
+    # It is indexed so the purge can find expired rows with a range scan.
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
 
     def add(self):
         # Add the current instance of the RevokedToken class to the database session
@@ -24,6 +30,21 @@ class RevokedToken(db.Model):
          # Return True if a token was found (i.e., the token is blacklisted), and False otherwise
         return bool(query)
 
+    @classmethod
+    # Deletes the rows of tokens that have expired. Rows are deleted in batches, each in its own transaction,
+    # so a large backlog doesn't hold one long lock on the table or build one huge transaction.
+    def purge_expired(cls, batch_size=1000):
+        now = datetime.now(timezone.utc)
+        purged = 0
+        while True:
+            # Select the ids of one batch first since PostgreSQL doesn't support LIMIT on DELETE.
+            expired_ids = db.session.query(cls.id).filter(cls.expires_at < now).limit(batch_size).subquery()
+            deleted = cls.query.filter(cls.id.in_(select(expired_ids))).delete(synchronize_session=False)
+            db.session.commit()
+            purged += deleted
+            if deleted < batch_size:
+                return purged
+
 #In some routes some fields are not required but in others they are,
 #having a blanket schema would remove the approriate requirement fields and error handling message for each routes which I coded into the baseschema validation.
 
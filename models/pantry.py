@@ -1,6 +1,8 @@
 from setup import db
 from marshmallow import fields, INCLUDE, ValidationError
 from datetime import datetime
+from sqlalchemy import update, select
+from sqlalchemy.dialects.postgresql import insert
 from .base_schema import BaseSchema
 
 
@@ -9,17 +11,59 @@ class Pantry(db.Model):
     pantry_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True)
     name = db.Column(db.Text(), nullable=False)
+    # Incremented (and updated_at set) in the same transaction as every change to the pantry's items.
+    # The pantry routes use them as the ETag and Last-Modified of their responses, so a client can skip downloading an unchanged pantry
+    # and can make sure nobody else changed the pantry since it read it before changing it (If-Match).
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    # The change log of the pantry (see PantryChange) only holds deletions made after this version, older ones have been compacted away.
+    changes_floor = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     # This line connect the Pantry to the User model. This establish a bi-directional relationship between the User and Pantry models. 
     # This means we can easily access the related User object from a Pantry object, and vice versa.
     user = db.relationship('User', back_populates='pantry')
     items = db.relationship('PantryItem', back_populates='pantry')
 
+    # Builds the INSERT ... SELECT creating the pantries of the users selected by 'users', a subquery or CTE with the users' id and username columns.
+    # Every pantry is created through this (see User.create_with_pantries and seeding.py), so they are all named the same way.
+    # The pantry's name is set to a string that includes the username of the User.
+    @staticmethod
+    def insert_for_users(users):
+        return Pantry.__table__.insert().from_select(['user_id', 'name'], select(users.c.id, users.c.username + "'s Pantry"))
+
+    # Returns the (version, updated_at) of a pantry, a single lookup on the primary key.
+    @staticmethod
+    def get_version(pantry_id):
+        return db.session.query(Pantry.version, Pantry.updated_at).filter(Pantry.pantry_id == pantry_id).one_or_none()
+
+    # Increments the version of a pantry with a single UPDATE, so concurrent changes can't both get the same version.
+    # With expected_versions, the version is only incremented if it is currently one of them. Returns the new version, or None if it wasn't incremented.
+    # The row stays locked until the transaction ends, so the item change committed with it can't be interleaved with another one.
+    @staticmethod
+    def bump_version(pantry_id, expected_versions=None):
+        statement = update(Pantry).where(Pantry.pantry_id == pantry_id).values(version=Pantry.version + 1, updated_at=db.func.now()).returning(Pantry.version)
+        if expected_versions is not None:
+            statement = statement.where(Pantry.version.in_(expected_versions))
+        return db.session.execute(statement.execution_options(synchronize_session=False)).scalar()
+
 class PantryItem(db.Model):
     __tablename__ = 'pantry_items'
+    # Every pantry route filters on pantry_id first, so all of the indexes below lead with it.
+    # This turns the used by/expired date ranges and the run out (count = 0) lookups into index range scans within the user's pantry.
+    # The unique index on (pantry_id, item) enforces in the database that an item only appears once per pantry and serves the lookups by item name.
+    # Any of these also serves a lookup on pantry_id alone, so pantry_id doesn't need an index of its own.
+    # Item names are case-insensitive. They are lowercased before being stored (see normalize_item in pantry_bp) and the check constraint makes sure of it,
+    # so the unique index is case-insensitive too. A lower(item) index would do the same but couldn't serve the ORDER BY item of the list routes or the ON CONFLICT of the bulk route.
+    __table_args__ = (
+        db.CheckConstraint('item = lower(item)', name='ck_pantry_items_item_lowercase'),
+        db.Index('ix_pantry_items_pantry_id_used_by_date', 'pantry_id', 'used_by_date'),
+        db.Index('ix_pantry_items_pantry_id_count', 'pantry_id', 'count'),
+        db.Index('uq_pantry_items_pantry_id_item', 'pantry_id', 'item', unique=True),
+    )
     item_id = db.Column(db.Integer, primary_key=True)
     pantry_id = db.Column(db.Integer, db.ForeignKey('pantries.pantry_id'))
     item = db.Column(db.Text(), nullable=False)
-    used_by_date = db.Column(db.Text(), nullable=False)  
+    # Stored as a native date so it can be compared and indexed without casting every row.
+    used_by_date = db.Column(db.Date, nullable=False)  
     count = db.Column(db.Integer, nullable=False)
     run_out_time = db.Column(db.DateTime, nullable=True)
     pantry = db.relationship('Pantry', back_populates='items')
@@ -48,10 +92,68 @@ class PantryItem(db.Model):
     @staticmethod
     def validate_used_by_date(date):
         try:
-            datetime.strptime(date, "%Y-%m-%d")
+            PantryItem.parse_used_by_date(date)
         except ValueError:
             raise ValidationError("used_by_date must be a string in the format 'yyyy-mm-dd'")
 
+    # The client sends used_by_date as a 'yyyy-mm-dd' string, this converts it to the date object stored in the used_by_date column.
+    @staticmethod
+    def parse_used_by_date(date):
+        return datetime.strptime(date, "%Y-%m-%d").date()
+
+# The change log of the pantries, which lets a client sync its copy of a pantry by fetching only what changed since the version it has.
+# There is one row per item of a pantry, holding the pantry version of the item's last change and whether that change deleted it (a tombstone).
+# Each change overwrites the item's row instead of appending a new one, so the log of an item that changes often doesn't grow,
+# and the log of a pantry stays about the size of the pantry. Only tombstones have to be compacted (see compact).
+class PantryChange(db.Model):
+    __tablename__ = 'pantry_changes'
+    # The unique index is the conflict target of record. The second index serves the lookup of the changes since a version.
+    __table_args__ = (
+        db.Index('uq_pantry_changes_pantry_id_item', 'pantry_id', 'item', unique=True),
+        db.Index('ix_pantry_changes_pantry_id_version', 'pantry_id', 'version'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    pantry_id = db.Column(db.Integer, db.ForeignKey('pantries.pantry_id'), nullable=False)
+    item = db.Column(db.Text(), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    changed_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+    # Records the items upserted and deleted by a change committed with the given pantry version, in one INSERT ... ON CONFLICT.
+    @staticmethod
+    def record(pantry_id, version, upserted=(), deleted=()):
+        rows = [{'pantry_id': pantry_id, 'item': item, 'version': version, 'deleted': False} for item in upserted]
+        rows += [{'pantry_id': pantry_id, 'item': item, 'version': version, 'deleted': True} for item in deleted]
+        if not rows:
+            return
+        statement = insert(PantryChange).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[PantryChange.pantry_id, PantryChange.item],
+            set_={'version': statement.excluded.version, 'deleted': statement.excluded.deleted, 'changed_at': db.func.now()},
+        )
+        db.session.execute(statement)
+
+    # Deletes the tombstones older than 'cutoff' and raises the changes_floor of their pantries to the newest version deleted,
+    # so a client asking for changes since an older version is told to fetch the whole pantry again instead of missing deletions.
+    # Like RevokedToken.purge_expired, rows are deleted in batches, each in its own transaction.
+    @classmethod
+    def compact(cls, cutoff, batch_size=1000):
+        compacted = 0
+        while True:
+            batch = db.session.query(cls.id, cls.pantry_id, cls.version).filter(cls.deleted.is_(True), cls.changed_at < cutoff).order_by(cls.id).limit(batch_size).subquery()
+            floors = db.session.query(batch.c.pantry_id, db.func.max(batch.c.version).label('version')).group_by(batch.c.pantry_id).subquery()
+            db.session.execute(
+                update(Pantry)
+                .where(Pantry.pantry_id == floors.c.pantry_id, Pantry.changes_floor < floors.c.version)
+                .values(changes_floor=floors.c.version)
+                .execution_options(synchronize_session=False)
+            )
+            deleted = cls.query.filter(cls.id.in_(select(batch.c.id))).delete(synchronize_session=False)
+            db.session.commit()
+            compacted += deleted
+            if deleted < batch_size:
+                return compacted
+
 # In some routes some fields are not required but in others they are,
 # having a blanket schema would remove the approriate requirement fields and error handling message for each routes which I coded into the baseschema validation.
 
@@ -74,4 +176,12 @@ class UpdatePantryItemSchema(BaseSchema):
 
     class Meta:
         unknown = INCLUDE
-        fields = ("used_by_date", "count")
\ No newline at end of file
+        fields = ("used_by_date", "count")
+
+# Used by the bulk route, a delete operation only needs the name of the item to delete.
+class DeletePantryItemSchema(BaseSchema):
+    item = fields.Str(required=True)
+
+    class Meta:
+        unknown = INCLUDE
+        fields = ("item",)
@@ -1,5 +1,5 @@
-from setup import db, bcrypt
-from sqlalchemy import event
+from setup import db, password_hasher
+from sqlalchemy import insert, select
 from marshmallow import ValidationError
 import re
 from models.pantry import Pantry
@@ -7,6 +7,12 @@ from models.pantry import Pantry
 
 class User(db.Model):
     __tablename__ = 'users'
+    # Usernames and emails are case-insensitive. They are lowercased before being stored (see process_and_normalize_data in users_bp), and these constraints
+    # make sure of it in the database. The unique indexes of the columns are then case-insensitive too, and serve the lookups by a lowercased value.
+    __table_args__ = (
+        db.CheckConstraint('username = lower(username)', name='ck_users_username_lowercase'),
+        db.CheckConstraint('email = lower(email)', name='ck_users_email_lowercase'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.Text(), unique=True, nullable=False) 
     password_hash = db.Column(db.Text(), nullable=False)
@@ -17,15 +23,45 @@ class User(db.Model):
     # This means we can easily access the related Pantry object from a User object, and vice versa.
     pantry = db.relationship('Pantry', back_populates='user', uselist=False)
 
-    # This method uses the bcrypt library's generate_password_hash function to create a hashed version of the input string.
-    # The hashed string is then decoded from bytes to a UTF-8 string and returned.
+    # This method uses the password hasher (see hashing.py) to create a bcrypt hashed version of the input string, with the configured work factor.
+    # The hashed string is returned as a UTF-8 string.
     def generate_hash(self, original):
-        return bcrypt.generate_password_hash(original).decode('utf-8')
+        return password_hasher.generate_hash(original)
 
-    # This method uses the bcrypt library's check_password_hash function. It takes two parameters: the hashed string and the original string.
+    # This method uses the password hasher to check a string against a hash. It takes two parameters: the hashed string and the original string.
     # It compares the hashed version of the original string with the stored hashed string. If they match, it returns True. Otherwise, it returns False.
+    # Repeating the same check within one request doesn't hash again.
     def check_hash(self, hashed, original):
-        return bcrypt.check_password_hash(hashed, original)
+        return password_hasher.check_hash(hashed, original)
+
+    # Called after 'original' has been successfully checked against the hash stored in 'field' (password_hash or security_answer).
+    # If that hash was generated with an older scheme or cost than the current settings, it is rehashed in the background
+    # so the response isn't slowed down. This migrates users to new hashing settings as they log in, without forcing resets.
+    def upgrade_hash(self, field, original):
+        old_hash = getattr(self, field)
+        if not password_hasher.needs_rehash(old_hash):
+            return
+        user_id = self.id
+
+        def save(new_hash):
+            # The hash is only replaced if it hasn't changed in the meantime, e.g. by a password reset, so a newer hash is never overwritten.
+            User.query.filter(User.id == user_id, getattr(User, field) == old_hash).update({field: new_hash}, synchronize_session=False)
+            db.session.commit()
+        password_hasher.rehash_later(original, save)
+
+    # Inserts users (dictionaries of column values) along with their pantries, since every user has exactly one, and returns the ids of the users.
+    # On PostgreSQL this is one statement, whatever the number of users: the users are inserted in a CTE and their pantries are inserted from its
+    # RETURNING rows. Registering costs a single round trip, and bulk imports create every pantry at once instead of one per user at flush time.
+    # Other databases can't insert in a CTE, so the users and the pantries are inserted by two statements.
+    @staticmethod
+    def create_with_pantries(rows):
+        if db.session.get_bind(User).dialect.name == 'postgresql':
+            new_users = insert(User).values(rows).returning(User.id, User.username).cte('new_users')
+            statement = Pantry.insert_for_users(new_users).returning(Pantry.user_id).add_cte(new_users)
+            return db.session.execute(statement).scalars().all()
+        user_ids = db.session.execute(insert(User).returning(User.id, sort_by_parameter_order=True), rows).scalars().all()
+        db.session.execute(Pantry.insert_for_users(select(User.id, User.username).where(User.id.in_(user_ids)).subquery()))
+        return user_ids
 
     def set_password(self, password):
         self.password_hash = self.generate_hash(password)
@@ -90,14 +126,3 @@ class User(db.Model):
     def validate_security_answer(security_answer):
         if not security_answer.isalpha():
             raise ValidationError("Security answer must only contain alphabetic characters. Special character and spaces are not accepted. Please note that answer will be case-insentitive")
-
-# This event listener decorator means that the function that follows will be executed after a new User record is inserted into the database. 
-# Since I want all users to have one pantry it made sense to automatically create one. 
-@event.listens_for(User, 'after_insert')
-# connection is the active database connection, and target is the actual User table that was just inserted. 
-# SQLAlchemy will still pass three arguments when the after_insert event is triggered hence why by convention I used _ as a placeholder for a parameter that is not used/needed.
-def create_pantry(_, connection, target):
-    # This line creates a new Pantry object associated with the newly created User. The name is set to a string that includes the username of the User
-    pantry = Pantry(user_id=target.id, name=f"{target.username}'s Pantry")
-    # A commit is not needed here because Flask-SQLAlchemy automatically commits the session at the end of the request. Adding a commit result in a ResourceClosedError 
-    db.session.add(pantry)
\ No newline at end of file
@@ -0,0 +1,211 @@
+import cProfile
+import os
+import random
+import threading
+import time
+import uuid
+from functools import wraps
+from flask import g, has_request_context, request
+from flask_jwt_extended.default_callbacks import default_decode_key_callback
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from metrics import Histogram, render_histogram
+
+# The phases of a request that are timed. 'jwt' is the decoding and verification of the token, up to the blocklist check.
+# 'parse' is parsing the JSON body, 'validation' the marshmallow schema and staticmethod validations, 'hashing' the password hashing,
+# 'sql' the time spent executing queries and 'serialization' building and encoding the response.
+PHASES = ('jwt', 'blocklist', 'parse', 'validation', 'hashing', 'sql', 'serialization')
+
+# Only the routes of these blueprints are profiled.
+PROFILED_BLUEPRINTS = ('users', 'pantry')
+
+# The upper bounds of the buckets of the queries per request histogram.
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+# The timings collected while handling one request, stored on 'g'.
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = {}
+        # When each phase first started. The jwt phase is measured as the time between the token decode starting and the blocklist check starting.
+        self.first_starts = {}
+        self.jwt_start = None
+        self.query_count = 0
+        self.cprofile = None
+
+    def add(self, phase, start, end):
+        self.durations[phase] = self.durations.get(phase, 0.0) + end - start
+        self.first_starts.setdefault(phase, start)
+
+
+def current_profile():
+    if has_request_context():
+        return g.get('profile')
+    return None
+
+
+# Times a phase of the current request, as a decorator (@timed('hashing')) or a context manager (with timed('validation'): ...).
+# When profiling is off it costs a single check: the decorated function is called directly, and the context manager records nothing.
+class timed:
+    def __init__(self, phase):
+        self.phase = phase
+        self.profile = None
+
+    def __enter__(self):
+        if request_profiler.enabled:
+            self.profile = current_profile()
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.add(self.phase, self.start, time.perf_counter())
+        return False
+
+    def __call__(self, function):
+        phase = self.phase
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not request_profiler.enabled:
+                return function(*args, **kwargs)
+            with timed(phase):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+# Opt-in (PROFILING_ENABLED) profiling of the routes of users_bp and pantry_bp. For every request it:
+# - times the phases in PHASES and counts the queries, and returns them in a Server-Timing header (shown by the browser's developer tools),
+# - records them in histograms per route, exposed by the /metrics route,
+# - for a sample of requests (PROFILE_SAMPLE_RATE), runs cProfile and saves the full profile to PROFILE_DIR when the request took at least PROFILE_SLOW_MS.
+# The saved profiles can be read with python -m pstats or a viewer such as snakeviz.
+class RequestProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.slow_seconds = 0.5
+        self.profile_dir = 'profiles'
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        # The profiler is shared by the process (see create_app), so nothing is kept from an app built before this one.
+        self.enabled = bool(app.config.get('PROFILING_ENABLED', False))
+        self.histograms = {}
+        if not self.enabled:
+            return
+        self.sample_rate = app.config.get('PROFILE_SAMPLE_RATE', self.sample_rate)
+        self.slow_seconds = app.config.get('PROFILE_SLOW_MS', self.slow_seconds * 1000) / 1000
+        self.profile_dir = app.config.get('PROFILE_DIR', self.profile_dir)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+        # Listening on the Engine class covers every engine, including the read replicas' and the ones created after this.
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        # Flask-JWT-Extended calls this to get the key right before decoding the token, which marks the start of the jwt phase.
+        from jwt_config import jwt
+        jwt.decode_key_loader(decode_key_loader)
+
+    def start_request(self):
+        if request.blueprint not in PROFILED_BLUEPRINTS:
+            return
+        profile = g.profile = RequestProfile()
+        if self.sample_rate and random.random() < self.sample_rate:
+            cprofile = cProfile.Profile()
+            try:
+                cprofile.enable()
+            except ValueError:
+                # Only one profiler can be active at a time in recent Python versions, so a request that starts while another is profiled isn't sampled.
+                return
+            profile.cprofile = cprofile
+
+    def finish_request(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.start
+        if profile.cprofile is not None:
+            profile.cprofile.disable()
+            if total >= self.slow_seconds:
+                self.save_profile(profile.cprofile, total)
+
+        durations = dict(profile.durations)
+        if profile.jwt_start is not None and 'blocklist' in profile.first_starts:
+            durations['jwt'] = profile.first_starts['blocklist'] - profile.jwt_start
+        timings = [f'{phase};dur={durations[phase] * 1000:.2f}' for phase in PHASES if phase in durations]
+        timings.append(f'total;dur={total * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        # The SQL time includes the time waiting for the database, the query count shows whether it comes from a few slow queries or many fast ones.
+        response.headers['Server-Timing'] += f', queries;desc="{profile.query_count} queries"'
+
+        endpoint = request.endpoint or 'unknown'
+        self.histogram(endpoint, 'total').observe(total)
+        for phase, duration in durations.items():
+            self.histogram(endpoint, phase).observe(duration)
+        self.histogram(endpoint, 'queries', QUERY_COUNT_BUCKETS).observe(profile.query_count)
+        return response
+
+    # finish_request isn't called when a request fails with an unhandled exception, so its profiler is stopped here.
+    def teardown_request(self, exception):
+        profile = g.pop('profile', None)
+        if profile is not None and profile.cprofile is not None:
+            profile.cprofile.disable()
+
+    def histogram(self, endpoint, name, buckets=None):
+        key = (endpoint, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets) if buckets else Histogram())
+        return histogram
+
+    def save_profile(self, cprofile, total):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{request.endpoint}-{total * 1000:.0f}ms-{uuid.uuid4().hex[:8]}.prof'
+        cprofile.dump_stats(os.path.join(self.profile_dir, name))
+
+    # Renders the histograms in the Prometheus text format, for the /metrics route.
+    def metrics(self):
+        histograms = sorted(self.histograms.items())
+        lines = []
+        lines += ['# HELP http_request_duration_seconds Time taken to handle a request.', '# TYPE http_request_duration_seconds histogram']
+        for (endpoint, name), histogram in histograms:
+            if name == 'total':
+                lines += render_histogram('http_request_duration_seconds', histogram, {'endpoint': endpoint, 'process': os.getpid()})
+        lines += ['# HELP http_request_phase_seconds Time taken by each phase of a request.', '# TYPE http_request_phase_seconds histogram']
+        for (endpoint, name), histogram in histograms:
+            if name in PHASES:
+                lines += render_histogram('http_request_phase_seconds', histogram, {'endpoint': endpoint, 'phase': name, 'process': os.getpid()})
+        lines += ['# HELP http_request_queries Number of SQL queries run by a request.', '# TYPE http_request_queries histogram']
+        for (endpoint, name), histogram in histograms:
+            if name == 'queries':
+                lines += render_histogram('http_request_queries', histogram, {'endpoint': endpoint, 'process': os.getpid()})
+        return lines
+
+
+request_profiler = RequestProfiler()
+
+
+# The SQL phase is timed with SQLAlchemy's cursor events, around the execution of every statement.
+# The start time is kept on the connection since the same connection runs the statement and fires both events.
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('profile_query_start')
+    if not starts:
+        return
+    start = starts.pop()
+    profile = current_profile()
+    if profile is not None:
+        profile.add('sql', start, time.perf_counter())
+        profile.query_count += 1
+
+def decode_key_loader(jwt_header, jwt_payload):
+    profile = current_profile()
+    if profile is not None and profile.jwt_start is None:
+        profile.jwt_start = time.perf_counter()
+    return default_decode_key_callback(jwt_header, jwt_payload)
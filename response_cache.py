@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from functools import wraps
+from urllib.parse import urlencode
+from flask import current_app, request
+from werkzeug.http import is_resource_modified
+from jwt_config import get_current_pantry_id
+from models.pantry import Pantry
+from utils import parse_whole_number
+
+# redis is an optional dependency, only needed when RESPONSE_CACHE_BACKEND is a redis:// URL.
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# An in-process cache backend: a bounded LRU (least recently used) dictionary where every entry also expires after its own time to live.
+# Its get, set and delete methods take the same arguments as the ones of a redis client, so the response cache can use either one
+# (or anything else implementing those three methods, like a local Redis compatible server in development).
+class MemoryCacheBackend:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    # Like redis, 'ex' is the time to live in seconds and with 'nx' the value is only set if the key doesn't exist yet.
+    # Returns True if the value was set and None otherwise.
+    def set(self, key, value, ex=None, nx=False):
+        with self.lock:
+            now = time.monotonic()
+            entry = self.entries.get(key)
+            if nx and entry is not None and (entry[1] is None or entry[1] > now):
+                return None
+            self.entries[key] = (value, now + ex if ex else None)
+            self.entries.move_to_end(key)
+            # Evict the least recently used entries once the cache is full.
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            return 1 if self.entries.pop(key, None) is not None else 0
+
+
+# Caches the encoded responses of the pantry read routes, per pantry, so a client polling an unchanged pantry doesn't re-run the query and serialization.
+# Conditional requests (ETag and Last-Modified from the pantry's version) are handled here too, see cached_response below.
+# - An entry is keyed by the pantry id, the route and its query parameters.
+# - Every pantry has a generation, a random token that is part of the key of all of its entries. Any change to the pantry deletes the generation,
+#   so the next read creates a new one and the old entries can't be reached anymore (they are evicted or expire on their own).
+#   This invalidates every cached route of a pantry with a single delete, whatever the parameters that were used.
+# - With the in-process backend every server process has its own cache and only sees the invalidations of the writes it handled,
+#   so a process can serve a response up to RESPONSE_CACHE_TTL seconds old. Use a redis backend shared by all processes when that matters.
+class ResponseCache:
+    def __init__(self):
+        self.backend = None
+        self.ttl = 60
+
+    def init_app(self, app):
+        self.ttl = app.config.get('RESPONSE_CACHE_TTL', self.ttl)
+        backend = app.config.get('RESPONSE_CACHE_BACKEND', 'none')
+        # The cache is shared by the process (see create_app), so the backend of an app built before this one is dropped.
+        self.backend = None
+        if backend == 'memory':
+            self.backend = MemoryCacheBackend(app.config.get('RESPONSE_CACHE_SIZE', 10000))
+        elif backend.startswith(('redis://', 'rediss://', 'unix://')):
+            if redis is None:
+                raise RuntimeError('redis must be installed to use a redis response cache backend')
+            self.backend = redis.Redis.from_url(backend)
+        elif backend != 'none':
+            raise ValueError("RESPONSE_CACHE_BACKEND must be 'none', 'memory' or a redis URL")
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def _generation(self, pantry_id):
+        key = f'pantry:{pantry_id}:generation'
+        # Only one new generation is kept if two requests create one at the same time.
+        self.backend.set(key, os.urandom(8).hex(), ex=self.ttl, nx=True)
+        generation = self.backend.get(key)
+        return generation.decode('utf-8') if isinstance(generation, bytes) else generation
+
+    # The key of the current request's response. The query parameters are sorted so their order doesn't matter.
+    # Today's date is part of the key too since which items are expired or need to be used soon depends on it.
+    def key(self, pantry_id):
+        query = urlencode(sorted(request.args.items(multi=True)))
+        return f'pantry:{pantry_id}:{self._generation(pantry_id)}:{date.today().isoformat()}:{request.path}?{query}'
+
+    # An entry is stored as the ETag, the Last-Modified date and the response body on one line each, so any backend storing bytes can hold it.
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        etag, last_modified, body = value.split(b'\n', 2)
+        return etag.decode('utf-8'), datetime.fromisoformat(last_modified.decode('utf-8')), body
+
+    def set(self, key, etag, last_modified, body):
+        self.backend.set(key, f'{etag}\n{last_modified.isoformat()}\n'.encode('utf-8') + body, ex=self.ttl)
+
+    # Called after every successful change to a pantry.
+    def invalidate(self, pantry_id):
+        if self.enabled:
+            self.backend.delete(f'pantry:{pantry_id}:generation')
+
+
+response_cache = ResponseCache()
+
+
+# The ETag and Last-Modified of a pantry's responses, built from the pantry's version and the time of its last change.
+# Both include the current day, since which items are expired or need to be used soon changes at midnight without the pantry changing.
+def pantry_validators(version, updated_at):
+    today = date.today()
+    # Some database drivers (SQLite for instance) hand back naive datetimes. The values are always in UTC.
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    midnight = datetime.combine(today, datetime.min.time()).astimezone(timezone.utc)
+    return f'{version}-{today:%Y%m%d}', max(updated_at, midnight)
+
+# The pantry versions the request's If-Match header refers to, or None when any version is fine (no header, or '*').
+def if_match_versions():
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = set()
+    for etag in request.if_match.as_set():
+        # Only the version part of the ETag matters here, an ETag from a previous day is still valid to change the pantry.
+        version = parse_whole_number(etag.split('-', 1)[0])
+        if version is not None:
+            versions.add(version)
+    return versions
+
+def not_modified(etag, last_modified):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+
+# Decorator for the pantry read routes. It must be placed under @jwt_required() since responses are per pantry,
+# and under @read_replica so the pantry's version is read from the same database as its items.
+# - Every response gets the pantry's version as its ETag and the time of its last change as its Last-Modified.
+# - A request whose If-None-Match (or If-Modified-Since) matches gets an empty 304 Not Modified before the route's query is run.
+# - Successful responses are cached as encoded bytes when a cache backend is configured, so a cached response (or a 304 for it) doesn't touch the database at all.
+def cached_response(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        pantry_id = get_current_pantry_id()
+        cached = None
+        if response_cache.enabled:
+            key = response_cache.key(pantry_id)
+            cached = response_cache.get(key)
+        if cached is not None:
+            etag, last_modified, body = cached
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                return not_modified(etag, last_modified)
+            response = current_app.response_class(body, mimetype=current_app.json.mimetype)
+        else:
+            # The version is read before the items. If the pantry changes in between, the response has the new items with the old version,
+            # so the client downloads it again next time. The other way around a client could keep old items forever.
+            pantry_version = Pantry.get_version(pantry_id)
+            if pantry_version is None:
+                return view(*args, **kwargs)
+            etag, last_modified = pantry_validators(*pantry_version)
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                return not_modified(etag, last_modified)
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            if response_cache.enabled:
+                response_cache.set(key, etag, last_modified, response.get_data())
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+    return wrapper
@@ -0,0 +1,96 @@
+import csv
+import io
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, select
+from setup import db, password_hasher
+from models.user import User
+from models.pantry import Pantry, PantryItem
+
+# The password and security answer of the generated users, unless others are given.
+DEFAULT_PASSWORD = 'Passw0rd!'
+DEFAULT_SECURITY_ANSWER = 'blue'
+SECURITY_QUESTION = 'What is your favourite childhood book'
+
+
+PREFIX_ERROR = 'The username prefix must only contain lowercase letters and digits.'
+
+# Usernames are alphanumeric (see User.validate_username) and stored in lowercase, which the users table's check constraint enforces.
+def is_valid_prefix(prefix):
+    return prefix.isascii() and prefix.isalnum() and prefix == prefix.lower()
+
+# Item names may only contain letters and spaces, so numbers are written in base 26 with the letters a to z.
+def letters(number):
+    name = ''
+    while True:
+        number, digit = divmod(number, 26)
+        name = chr(ord('a') + digit) + name
+        if number == 0:
+            return name
+
+def item_name(index):
+    return f'seed {letters(index)}'
+
+# The items of one generated pantry: a mix of items that have run out, expired, or are to be used within the next year, so every list route has results.
+def generate_items(pantry_id, count, today, now):
+    return [
+        {'pantry_id': pantry_id, 'item': item_name(index), 'used_by_date': today + timedelta(days=index % 400 - 30),
+         'count': index % 5, 'run_out_time': now if index % 5 == 0 else None}
+        for index in range(count)
+    ]
+
+# Inserts rows (dictionaries with the given columns) into a table. On PostgreSQL the rows are streamed with COPY, which is several times faster
+# than even a batched INSERT. Other databases get a single executemany. None values become NULLs, the generated data has no empty strings.
+def insert_rows(table, columns, rows):
+    if not rows:
+        return
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        connection.execute(table.insert(), rows)
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows([row[column] for column in columns] for row in rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+# Generates 'users' users named <prefix><start> to <prefix><start + users - 1>, each with a pantry holding 'items_per_user' items.
+# It writes straight to the tables, a batch of 'batch_size' users per transaction:
+# - the users are inserted in bulk,
+# - their pantries are then created by a single INSERT ... SELECT (Pantry.insert_for_users, as for registrations),
+# - their items are inserted in bulk.
+# The password and security answer are hashed once and shared by every generated user, instead of running bcrypt for each one.
+# 'progress', if given, is called with the number of users generated so far after every batch.
+def seed(users, items_per_user, prefix='seeduser', start=0, batch_size=1000, password=DEFAULT_PASSWORD, security_answer=DEFAULT_SECURITY_ANSWER, progress=None):
+    # Checked before anything is written, since the batches are committed one by one and the database would only reject the prefix partway through.
+    if not is_valid_prefix(prefix):
+        raise ValueError(PREFIX_ERROR)
+    password_hash = password_hasher.generate_hash(password)
+    security_answer_hash = password_hasher.generate_hash(security_answer)
+    today = date.today()
+    now = datetime.now()
+    user_columns = ['username', 'email', 'password_hash', 'security_question', 'security_answer']
+    item_columns = ['pantry_id', 'item', 'used_by_date', 'count', 'run_out_time']
+
+    for batch_start in range(start, start + users, batch_size):
+        batch_end = min(batch_start + batch_size, start + users)
+        # The ids of the users of this batch are all above the largest id before it.
+        last_id = db.session.execute(select(func.coalesce(func.max(User.id), 0))).scalar()
+        insert_rows(User.__table__, user_columns, [
+            {'username': f'{prefix}{index}', 'email': f'{prefix}{index}@example.com', 'password_hash': password_hash,
+             'security_question': SECURITY_QUESTION, 'security_answer': security_answer_hash}
+            for index in range(batch_start, batch_end)
+        ])
+        new_users = select(User.id, User.username).where(
+            User.id > last_id, ~select(Pantry.pantry_id).where(Pantry.user_id == User.id).exists()
+        ).subquery()
+        db.session.execute(Pantry.insert_for_users(new_users))
+        if items_per_user:
+            pantry_ids = db.session.execute(select(Pantry.pantry_id).join(User, User.id == Pantry.user_id).where(User.id > last_id)).scalars()
+            insert_rows(PantryItem.__table__, item_columns, [row for pantry_id in pantry_ids for row in generate_items(pantry_id, items_per_user, today, now)])
+        db.session.commit()
+        if progress:
+            progress(batch_end - start)
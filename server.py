@@ -0,0 +1,66 @@
+import os
+from gunicorn.app.base import BaseApplication
+
+
+# The number of worker processes and threads per worker when they aren't configured, derived from the number of CPUs.
+# - threaded: gunicorn's usual (2 x CPUs) + 1 processes, each with a few threads, so requests waiting on the database don't leave the CPUs idle.
+# - gevent: one process per CPU, the concurrency comes from the greenlets of each process (see wsgi.py).
+def default_workers(server_mode):
+    cpus = os.cpu_count() or 1
+    if server_mode == 'gevent':
+        return cpus
+    return cpus * 2 + 1
+
+
+# Runs the app under gunicorn from within the 'flask serve' command, with the settings of the app config (see the WEB_* settings in setup.py).
+# The app is loaded once in the master process before the workers are forked (preload), so the workers share the memory of the imported code
+# and a broken app fails at startup instead of in every worker.
+class Server(BaseApplication):
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+# Builds the gunicorn settings from the app config.
+def server_options(app, bind=None, workers=None, threads=None):
+    config = app.config
+    gevent = config['SERVER_MODE'] == 'gevent'
+
+    # A forked worker starts with a copy of the master's connection pools. Connections opened by the master (e.g. by the revoked token purger)
+    # would then be shared by several processes, and their messages to the database interleaved.
+    # dispose(close=False) gives the worker new empty pools without closing the master's connections, which are still in use by the master.
+    def post_fork(server, worker):
+        with app.app_context():
+            db = app.extensions['sqlalchemy']
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+    options = {
+        'bind': bind or config['WEB_BIND'],
+        'workers': workers or config['WEB_WORKERS'] or default_workers(config['SERVER_MODE']),
+        'worker_class': 'gevent' if gevent else 'gthread',
+        'preload_app': True,
+        # A worker that doesn't answer the master for this long is killed and replaced.
+        'timeout': config['WEB_TIMEOUT'],
+        # On a graceful stop or reload (SIGHUP), workers get this long to finish their current requests.
+        'graceful_timeout': config['WEB_GRACEFUL_TIMEOUT'],
+        # Workers are restarted after this many requests (0 never), with some jitter so they don't all restart at once.
+        'max_requests': config['WEB_MAX_REQUESTS'],
+        'max_requests_jitter': config['WEB_MAX_REQUESTS'] // 10,
+        'post_fork': post_fork,
+    }
+    if gevent:
+        options['worker_connections'] = config['WEB_WORKER_CONNECTIONS']
+    else:
+        options['threads'] = threads or config['WEB_THREADS']
+    if config['WEB_PIDFILE']:
+        options['pidfile'] = config['WEB_PIDFILE']
+    return options
@@ -0,0 +1,57 @@
+import os
+import sys
+import pytest
+
+# Allow the app modules to be imported when pytest is run from the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from setup import db
+
+PASSWORD = 'Passw0rd!a'
+
+
+# An app on an in-memory SQLite database, with a low bcrypt work factor so the user routes are quick.
+# The extensions are shared by the process, and create_app reconfigures them from scratch for every test (see create_app).
+@pytest.fixture
+def app():
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'SQLALCHEMY_BINDS': {},
+        'SQLALCHEMY_ENGINE_OPTIONS': {},
+        'BCRYPT_LOG_ROUNDS': 4,
+        'SECRET_KEY': 'test-secret-key-test-secret-key-test',
+        'JWT_SECRET_KEY': 'test-secret-key-test-secret-key-test',
+    })
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+# Registers a user and returns the Authorization header of a freshly logged in token.
+def register_and_login(client, username='testuser'):
+    client.post('/users/register', json={'username': username, 'email': f'{username}@example.com', 'password': PASSWORD, 'security_answer': 'blue'})
+    response = client.post('/users/login', json={'username': username, 'password': PASSWORD})
+    return {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+
+@pytest.fixture
+def login(client):
+    return lambda username='testuser': register_and_login(client, username)
+
+@pytest.fixture
+def auth(client):
+    return register_and_login(client)
+
+# Adds pantry items to the user's pantry in one request to the bulk route.
+@pytest.fixture
+def add_items(client, auth):
+    def add(names, used_by_date='2030-01-01', count=1):
+        operations = [{'op': 'upsert', 'item': name, 'used_by_date': used_by_date, 'count': count} for name in names]
+        response = client.post('/pantry/items/bulk', json=operations, headers=auth)
+        assert response.status_code == 200, response.get_json()
+    return add
@@ -0,0 +1,42 @@
+def test_bulk_upserts_and_deletes(client, auth, add_items):
+    add_items(['milk', 'bread'])
+    operations = [
+        {'op': 'upsert', 'item': 'Milk', 'used_by_date': '2031-01-01', 'count': 0},
+        {'op': 'upsert', 'item': 'eggs', 'used_by_date': '2030-06-01', 'count': 12},
+        {'op': 'delete', 'item': 'bread'},
+        {'op': 'delete', 'item': 'butter'},
+    ]
+    response = client.post('/pantry/items/bulk', json=operations, headers=auth)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['deleted'] == 1
+    assert body['not_found'] == ['butter']
+    items = {item['item']: item for item in client.get('/pantry/', headers=auth).get_json()['message']}
+    assert set(items) == {'eggs', 'milk'}
+    assert items['milk']['used_by_date'] == '2031-01-01'
+    # The count went to 0, so the item has run out.
+    assert items['milk']['run_out_time'] is not None
+
+def test_invalid_operations_are_reported_by_index_and_nothing_is_changed(client, auth, add_items):
+    add_items(['milk'])
+    operations = [
+        {'op': 'delete', 'item': 'milk'},
+        {'op': 'rename', 'item': 'bread'},
+        {'op': 'upsert', 'item': 'eggs', 'used_by_date': 'tomorrow', 'count': 1},
+        {'op': 'upsert', 'item': 'milk', 'used_by_date': '2030-01-01', 'count': 1},
+    ]
+    response = client.post('/pantry/items/bulk', json=operations, headers=auth)
+    assert response.status_code == 400
+    errors = response.get_json()['errors']
+    assert set(errors) == {'1', '2', '3'}
+    assert 'op' in errors['1']
+    assert 'more than one operation' in errors['3']['item']
+    assert client.get('/pantry/milk', headers=auth).status_code == 200
+
+def test_bulk_rejects_an_empty_list(client, auth):
+    assert client.post('/pantry/items/bulk', json=[], headers=auth).status_code == 400
+
+def test_bulk_rejects_too_many_operations(app, client, auth):
+    app.config['PANTRY_BULK_MAX_OPERATIONS'] = 2
+    operations = [{'op': 'delete', 'item': name} for name in ('milk', 'bread', 'eggs')]
+    assert client.post('/pantry/items/bulk', json=operations, headers=auth).status_code == 400
@@ -0,0 +1,42 @@
+def sync(client, auth, since):
+    response = client.get(f'/pantry/changes?since={since}', headers=auth)
+    assert response.status_code == 200
+    return response.get_json()
+
+def test_full_sync_returns_every_item(client, auth, add_items):
+    add_items(['milk', 'bread'])
+    body = sync(client, auth, 0)
+    assert sorted(item['item'] for item in body['message']) == ['bread', 'milk']
+    assert body['deleted'] == []
+
+def test_sync_returns_only_the_changes_since_a_version(client, auth, add_items):
+    add_items(['milk', 'bread'])
+    version = sync(client, auth, 0)['version']
+    add_items(['eggs'])
+    body = sync(client, auth, version)
+    assert [item['item'] for item in body['message']] == ['eggs']
+    assert body['version'] > version
+
+def test_deleted_items_are_returned_as_tombstones(client, auth, add_items):
+    add_items(['milk', 'bread'])
+    version = sync(client, auth, 0)['version']
+    assert client.delete('/pantry/milk', headers=auth).status_code == 200
+    body = sync(client, auth, version)
+    assert body['message'] == []
+    assert body['deleted'] == ['milk']
+
+def test_item_added_again_after_a_delete_is_not_a_tombstone(client, auth, add_items):
+    add_items(['milk'])
+    version = sync(client, auth, 0)['version']
+    client.delete('/pantry/milk', headers=auth)
+    add_items(['milk'])
+    body = sync(client, auth, version)
+    assert [item['item'] for item in body['message']] == ['milk']
+    assert body['deleted'] == []
+
+def test_sync_up_to_date_returns_nothing(client, auth, add_items):
+    add_items(['milk'])
+    version = sync(client, auth, 0)['version']
+    body = sync(client, auth, version)
+    assert body['message'] == []
+    assert body['deleted'] == []
@@ -0,0 +1,58 @@
+# ETags and If-Match: a client can skip downloading an unchanged pantry, and can't overwrite a change it hasn't seen.
+
+
+def test_read_returns_the_pantry_version_as_etag(client, auth, add_items):
+    add_items(['milk'])
+    response = client.get('/pantry/', headers=auth)
+    assert response.status_code == 200
+    assert response.headers['ETag']
+    assert response.headers['Last-Modified']
+
+def test_unchanged_pantry_returns_304(client, auth, add_items):
+    add_items(['milk'])
+    etag = client.get('/pantry/', headers=auth).headers['ETag']
+    response = client.get('/pantry/', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+def test_changed_pantry_returns_200(client, auth, add_items):
+    add_items(['milk'])
+    etag = client.get('/pantry/', headers=auth).headers['ETag']
+    add_items(['bread'])
+    response = client.get('/pantry/', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+def test_update_with_current_etag_succeeds(client, auth, add_items):
+    add_items(['milk'])
+    etag = client.get('/pantry/', headers=auth).headers['ETag']
+    response = client.put('/pantry/milk', json={'count': 5}, headers={**auth, 'If-Match': etag})
+    assert response.status_code == 200
+
+def test_update_with_stale_etag_returns_412(client, auth, add_items):
+    add_items(['milk'])
+    etag = client.get('/pantry/', headers=auth).headers['ETag']
+    add_items(['bread'])
+    response = client.put('/pantry/milk', json={'count': 5}, headers={**auth, 'If-Match': etag})
+    assert response.status_code == 412
+    # Nothing was changed.
+    assert client.get('/pantry/milk', headers=auth).get_json()['message']['count'] == 1
+
+def test_bulk_with_stale_etag_returns_412(client, auth, add_items):
+    add_items(['milk'])
+    etag = client.get('/pantry/', headers=auth).headers['ETag']
+    add_items(['bread'])
+    operations = [{'op': 'delete', 'item': 'milk'}]
+    response = client.post('/pantry/items/bulk', json=operations, headers={**auth, 'If-Match': etag})
+    assert response.status_code == 412
+    assert client.get('/pantry/milk', headers=auth).status_code == 200
+
+def test_unparsable_if_match_returns_412(client, auth, add_items):
+    add_items(['milk'])
+    response = client.put('/pantry/milk', json={'count': 5}, headers={**auth, 'If-Match': '"²"'})
+    assert response.status_code == 412
+
+def test_if_match_star_always_matches(client, auth, add_items):
+    add_items(['milk'])
+    response = client.put('/pantry/milk', json={'count': 5}, headers={**auth, 'If-Match': '*'})
+    assert response.status_code == 200
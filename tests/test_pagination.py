@@ -0,0 +1,49 @@
+import pytest
+from blueprints.pantry_bp import decode_cursor, encode_cursor, get_item_serializer
+
+
+@pytest.mark.parametrize('item', ['milk', 'olive oil', 'crème fraîche', 'a' * 200])
+def test_cursor_round_trip(item):
+    cursor = encode_cursor(item)
+    assert cursor.isascii()
+    assert decode_cursor(cursor) == item
+
+def test_invalid_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        decode_cursor('not a cursor!')
+
+def test_pages_cover_every_item_once(client, auth, add_items):
+    names = [f'item {letter}' for letter in 'abcdefg']
+    add_items(names)
+    seen = []
+    query = '/pantry/?limit=3'
+    while True:
+        body = client.get(query, headers=auth).get_json()
+        page = [item['item'] for item in body['message']]
+        assert len(page) <= 3
+        seen += page
+        if body['next_cursor'] is None:
+            break
+        query = f"/pantry/?limit=3&cursor={body['next_cursor']}"
+    assert seen == sorted(names)
+
+def test_garbage_cursor_returns_400(client, auth, add_items):
+    add_items(['milk'])
+    assert client.get('/pantry/?cursor=%%%', headers=auth).status_code == 400
+
+@pytest.mark.parametrize('limit', ['0', '-1', 'ten', '%C2%B2', '100000'])
+def test_invalid_limit_returns_400(client, auth, limit):
+    assert client.get(f'/pantry/?limit={limit}', headers=auth).status_code == 400
+
+@pytest.mark.parametrize('since', ['', 'abc', '%C2%B2'])
+def test_invalid_since_returns_400(client, auth, since):
+    assert client.get(f'/pantry/changes?since={since}', headers=auth).status_code == 400
+
+# Repeated or reordered fields share one serializer instead of adding an entry to its cache each.
+def test_fields_share_one_serializer(client, auth, add_items):
+    add_items(['milk'])
+    get_item_serializer.cache_clear()
+    for fields in ('count,item', 'item,count', 'count,item,count', 'count,count,count,item'):
+        body = client.get(f'/pantry/?fields={fields}', headers=auth).get_json()
+        assert body['message'] == [{'item': 'milk', 'count': 1}]
+    assert get_item_serializer.cache_info().currsize == 1
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta, timezone
+import time
+from models.authorization import RevokedToken
+from token_cache import BloomFilter, RevokedTokenCache
+
+
+def revoke(jti, token_id=None):
+    RevokedToken(id=token_id, jti=jti, expires_at=datetime.now(timezone.utc) + timedelta(hours=1)).add()
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000)
+    values = [f'jti-{index}' for index in range(1000)]
+    for value in values:
+        bloom.add(value)
+    assert all(value in bloom for value in values)
+    # Sized for a 1% false positive rate, so far fewer than 5% of unknown values should match.
+    assert sum(f'other-{index}' in bloom for index in range(1000)) < 50
+
+def test_bloom_filter_counts_a_value_once():
+    bloom = BloomFilter(100)
+    bloom.add('jti')
+    bloom.add('jti')
+    assert bloom.count == 1
+
+def test_lru_evicts_the_least_recently_used_jti(app):
+    cache = RevokedTokenCache(lru_size=2)
+    exp = time.time() + 3600
+    for jti in ('a', 'b', 'c'):
+        cache.add(jti, exp)
+    assert list(cache.revoked) == ['b', 'c']
+
+def test_evicted_jti_is_checked_against_the_database(app):
+    cache = RevokedTokenCache(lru_size=1, sync_interval=3600)
+    exp = time.time() + 3600
+    revoke('a')
+    assert cache.is_revoked('a', exp)
+    cache.add('b', exp)
+    assert 'a' not in cache.revoked
+    assert cache.is_revoked('a', exp)
+
+def test_unknown_jti_is_not_revoked(app):
+    cache = RevokedTokenCache(sync_interval=3600)
+    revoke('a')
+    assert not cache.is_revoked('b', time.time() + 3600)
+
+# Ids are handed out at insert time, so a row can commit after a row with a higher id has already been synced.
+def test_sync_picks_up_a_row_committed_out_of_id_order(app):
+    cache = RevokedTokenCache(sync_interval=0)
+    exp = time.time() + 3600
+    revoke('second', token_id=2)
+    assert cache.is_revoked('second', exp)
+    assert cache.last_seen_id == 2
+    revoke('first', token_id=1)
+    assert cache.is_revoked('first', exp)
+    # Rows read again by the overlap are not counted twice.
+    assert cache.bloom.count == 2
+
+def test_expired_rows_are_left_out_of_the_bloom_filter(app):
+    RevokedToken(jti='old', expires_at=datetime.now(timezone.utc) - timedelta(minutes=1)).add()
+    cache = RevokedTokenCache()
+    cache.warm()
+    assert 'old' not in cache.bloom
+
+def test_logged_out_token_is_rejected(client, auth):
+    assert client.get('/pantry/', headers=auth).status_code == 200
+    assert client.post('/users/logout', headers=auth).status_code == 200
+    assert client.get('/pantry/', headers=auth).status_code == 401
@@ -0,0 +1,218 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from sqlalchemy.exc import SQLAlchemyError
+from models.authorization import RevokedToken
+from setup import db
+
+
+# A bloom filter is a fixed size bit array that can tell us with certainty that a value has NEVER been added to it.
+# It can give false positives (it might say a jti is in there when it isn't) but never false negatives.
+# That is exactly what I need for the blocklist since the large majority of tokens checked are not revoked,
+# and a "definitely not in there" answer lets us skip the database query entirely.
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        # Standard formulas to size the bit array and the number of hash functions from the expected number of entries and acceptable false positive rate.
+        # 0.4805 is ln(2)^2 and 0.6931 is ln(2).
+        self.size = max(8, int(-capacity * math.log(error_rate) / 0.4805))
+        self.hash_count = max(1, int(self.size / capacity * 0.6931))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    # Double hashing: two independent 64 bit values from one blake2b digest are combined to derive all of the bit positions.
+    # This is much cheaper than computing one separate hash per position.
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little')
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    # Adding a value that is already in the filter changes no bits, so it isn't counted again either.
+    # The count then only grows with new values, and a jti added by the logout route and seen again by a sync counts once.
+    def add(self, value):
+        positions = self._positions(value)
+        if all(self.bits[position >> 3] & (1 << (position & 7)) for position in positions):
+            return
+        for position in positions:
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+# This class sits in front of RevokedToken.is_jti_blacklisted so that checking a token on every @jwt_required route doesn't cost a database round-trip.
+# It is made of two layers:
+# 1. A bloom filter holding every revoked jti. A negative answer means the token is not revoked and the database is never touched.
+# 2. A bounded LRU (least recently used) dictionary of jtis we know are revoked, mapped to the token's own 'exp' timestamp.
+#    Once a token has expired Flask-JWT-Extended rejects it before the blocklist is even checked, so there is no point keeping it in memory past that time.
+# Only a positive bloom answer that is not in the LRU (a false positive or an evicted entry) falls back to the database.
+class RevokedTokenCache:
+    def __init__(self, capacity=100000, lru_size=10000, sync_interval=5, sync_overlap=1000):
+        self.capacity = capacity
+        self.lru_size = lru_size
+        # Every worker process has its own copy of this cache, so a logout handled by another worker would not be seen here.
+        # To stay correct I pull any newly revoked rows from the database at most once every 'sync_interval' seconds.
+        # That is one cheap query on the primary key per interval per worker instead of one query per request.
+        self.sync_interval = sync_interval
+        # Ids are handed out when a row is inserted, not when it is committed, so two logouts running at once can commit out of id order.
+        # A row committing after a row with a higher id has been synced would be skipped for good if the sync only read ids above the last one seen.
+        # Every sync therefore reads the last 'sync_overlap' ids again. The jtis seen before are already in the bloom filter and adding them is a no-op.
+        self.sync_overlap = sync_overlap
+        # None until the revoked tokens have been loaded for the first time. Until then every check goes to the database.
+        self.bloom = None
+        self.revoked = OrderedDict()
+        self.last_seen_id = 0
+        self.last_sync = None
+        self.syncing = False
+        self.lock = threading.Lock()
+
+    # Loads every revoked jti into the bloom filter. This happens on the first token check after startup and then again whenever the bloom filter is full.
+    def warm(self):
+        with self.lock:
+            self.last_sync = None
+        self._sync_if_due()
+
+    # Syncs with the database if it is due: a full rebuild the first time or once the bloom filter is full, otherwise the rows added since the last sync.
+    # The query runs outside of the lock so a slow database doesn't block the request threads, and only one thread syncs at a time.
+    # The others keep using the current bloom filter meanwhile (or the database, before the first load).
+    def _sync_if_due(self):
+        with self.lock:
+            if self.syncing:
+                return
+            rebuild = self.last_sync is None
+            if not rebuild and time.monotonic() - self.last_sync < self.sync_interval:
+                return
+            self.syncing = True
+            after_id = 0 if rebuild else max(0, self.last_seen_id - self.sync_overlap)
+        try:
+            tokens = self._fetch(after_id)
+            # A rebuilt bloom filter is filled outside of the lock too, the requests keep using the current one until it is swapped in.
+            bloom = self._fill(BloomFilter(self.capacity), tokens) if rebuild else None
+        except BaseException:
+            with self.lock:
+                self.syncing = False
+            raise
+        with self.lock:
+            if rebuild:
+                # The tokens revoked by this worker while the rows were read may not have been committed yet when the query ran.
+                for jti in self.revoked:
+                    bloom.add(jti)
+                self.bloom = bloom
+            else:
+                self._fill(self.bloom, tokens)
+            if rebuild:
+                self.last_seen_id = tokens[-1][0] if tokens else 0
+            elif tokens:
+                self.last_seen_id = max(self.last_seen_id, tokens[-1][0])
+            self.last_sync = time.monotonic()
+            # A bloom filter can't have entries removed and its false positive rate climbs once it holds more than it was sized for.
+            # When that happens it is rebuilt from scratch on the next check.
+            if self.bloom.count > self.capacity:
+                self.last_sync = None
+            self.syncing = False
+
+    # The revoked tokens with an id above 'after_id', in id order.
+    def _fetch(self, after_id):
+        return RevokedToken.query.with_entities(RevokedToken.id, RevokedToken.jti, RevokedToken.expires_at).filter(RevokedToken.id > after_id).order_by(RevokedToken.id).all()
+
+    @staticmethod
+    def _fill(bloom, tokens):
+        now = datetime.now(timezone.utc)
+        for _, jti, expires_at in tokens:
+            # Expired tokens are rejected before the blocklist is checked, so they don't need to take up room in the bloom filter.
+            if _as_utc(expires_at) > now:
+                bloom.add(jti)
+        return bloom
+
+    def _remember(self, jti, exp):
+        self.revoked[jti] = exp
+        self.revoked.move_to_end(jti)
+        # Evict the least recently used jti once the LRU is full. It is still in the bloom filter so we can always fall back to the database.
+        while len(self.revoked) > self.lru_size:
+            self.revoked.popitem(last=False)
+
+    # Called by the logout route so that the worker that handled the logout rejects the token straight away.
+    def add(self, jti, exp):
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(jti)
+            self._remember(jti, exp)
+
+    def is_revoked(self, jti, exp):
+        self._sync_if_due()
+        with self.lock:
+            # Before the first load the bloom filter can't answer, the check falls back to the database below.
+            if self.bloom is not None:
+                # Negative bloom answer: the jti has never been revoked, no database query required.
+                if jti not in self.bloom:
+                    return False
+            cached_exp = self.revoked.get(jti)
+            if cached_exp is not None:
+                # The token has expired, drop it from memory. Flask-JWT-Extended would reject it anyway.
+                if cached_exp <= time.time():
+                    del self.revoked[jti]
+                else:
+                    self.revoked.move_to_end(jti)
+                return True
+
+        # Either a bloom false positive, an entry evicted from the LRU or a check before the first load, so ask the database.
+        # This is done outside of the lock so that a slow query doesn't block other request threads.
+        revoked = RevokedToken.is_jti_blacklisted(jti)
+        if revoked:
+            with self.lock:
+                self._remember(jti, exp)
+        return revoked
+
+
+# Some database drivers (SQLite for instance) hand back naive datetimes even for timezone aware columns. The values are always stored in UTC.
+def _as_utc(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+revoked_token_cache = RevokedTokenCache()
+
+
+# Reads the cache size and sync settings from the Flask config so they can be tuned per deployment without code changes.
+def init_revoked_token_cache(app):
+    revoked_token_cache.capacity = app.config.get('REVOKED_TOKEN_BLOOM_CAPACITY', revoked_token_cache.capacity)
+    revoked_token_cache.lru_size = app.config.get('REVOKED_TOKEN_LRU_SIZE', revoked_token_cache.lru_size)
+    revoked_token_cache.sync_interval = app.config.get('REVOKED_TOKEN_SYNC_SECONDS', revoked_token_cache.sync_interval)
+    revoked_token_cache.sync_overlap = app.config.get('REVOKED_TOKEN_SYNC_OVERLAP', revoked_token_cache.sync_overlap)
+    # The cache is shared by the process (see create_app). Another app may use another database, so what was loaded for an earlier app is dropped.
+    with revoked_token_cache.lock:
+        revoked_token_cache.bloom = None
+        revoked_token_cache.revoked = OrderedDict()
+        revoked_token_cache.last_seen_id = 0
+        revoked_token_cache.last_sync = None
+
+
+# Optional in-process job that periodically deletes expired rows from the revoked_tokens table.
+# It is disabled unless REVOKED_TOKEN_PURGE_SECONDS is set, since the same job can also be scheduled externally with 'flask purge-tokens' (e.g. from cron).
+def start_revoked_token_purger(app):
+    interval = app.config.get('REVOKED_TOKEN_PURGE_SECONDS', 0)
+    if not interval:
+        return None
+
+    def purge_forever():
+        while True:
+            time.sleep(interval)
+            # The thread runs outside of any request so it needs its own application context to use the database session.
+            with app.app_context():
+                try:
+                    RevokedToken.purge_expired(app.config.get('REVOKED_TOKEN_PURGE_BATCH', 1000))
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    # A failed purge is not fatal, the rows will be picked up by the next run.
+                    app.logger.exception('Purging expired revoked tokens failed')
+
+    # A daemon thread doesn't stop the process from exiting.
+    purger = threading.Thread(target=purge_forever, name='revoked-token-purger', daemon=True)
+    purger.start()
+    return purger
@@ -1,7 +1,9 @@
 from flask import jsonify, request
 from marshmallow import Schema, fields, ValidationError
-from models.user import User
-from models.pantry import PantryItem, Pantry
+from sqlalchemy import or_
+from setup import db
+from models.pantry import PantryItem
+from profiling import timed
 import json
 
 #refractor the format of return responses in my routes since they all have to be consistently json.
@@ -12,33 +14,45 @@ import json
 def create_response(message, status_code, **kwargs):
     response = {'message': message}
     response.update(kwargs)
-    return jsonify(response), status_code
+    with timed('serialization'):
+        return jsonify(response), status_code
+
+# Raised while parsing a JSON body that contains the same key twice in one object.
+class DuplicateKeysError(ValueError):
+    pass
 
 #  When you load a JSON string into a dictionary using Marshmallow, it will only keep the last value of any duplicate keys. However I don't want duplicate keys to be accepted at all.
+# This is used as the 'object_pairs_hook' of json.loads, so it is called for every object in the JSON (including nested ones) while it is being parsed.
 def check_duplicate_keys(pairs):
-    keys = [key for key, value in pairs]
-    # if the length of the list of keys is not equal to the length of the set of keys, it means there are duplicates
-    if len(keys) != len(set(keys)):
-        # If there are duplicate keys, return an error message as a JSON response
+    result = dict(pairs)
+    # if the dictionary has less keys than there are pairs, it means some keys were duplicated
+    if len(result) != len(pairs):
+        # Stop parsing straight away, parse_json_body turns this into an error response.
+        raise DuplicateKeysError()
+    return result
+
+# Parses the request body in a single pass, checking for duplicate keys at the same time.
+# The parsed data is returned directly, so there is no need to parse the body a second time with request.get_json().
+def parse_json_body(request):
+    try:
+        with timed('parse'):
+            return json.loads(request.get_data(), object_pairs_hook=check_duplicate_keys)
+    except DuplicateKeysError:
         # The status code 400 indicates a 'Bad Request' error
         return create_response({"error": "You have put some fields twice in your json file. Data could not be registered."}, 400)
-        # If there are no duplicate keys, convert the pairs back into a dictionary and return it
-    return dict(pairs)
+    except ValueError:
+        return create_response({"error": "The request body must be valid JSON."}, 400)
 
 #validate json data against schemas 
 def validate_data(request, schema):
-    # Get the raw JSON data from the request
-    raw_json = request.get_data(as_text=True)
+    # Parse the JSON data of the request, checking for duplicate keys.
+    data = parse_json_body(request)
+    if isinstance(data, tuple):  
+        return data
 
-    # Load the JSON data and check for duplicate keys using the 'check_duplicate_keys' function
-    result = json.loads(raw_json, object_pairs_hook=check_duplicate_keys)
-    if isinstance(result, tuple):  
-        return result
-
-    # If there were no duplicate keys, get the JSON data from the request
-    data = request.get_json()
     # validates the structure and types of the raw JSON data from the request against the schema.
-    errors = schema.validate(data)
+    with timed('validation'):
+        errors = schema.validate(data)
     if errors:
         # The 'create_response' function cannot be used here because it expects a string message and optional keyword arguments.
         # However, 'errors' is a dictionary where each key-value pair represents a field that failed validation and its corresponding error message.
@@ -47,6 +61,16 @@ def validate_data(request, schema):
     # If the data is valid, return it
     return data
 
+# Loads a JSON array from the request body, for routes that accept several items at once.
+# Each object in the array goes through the same duplicate keys check as validate_data.
+def load_json_list(request):
+    result = parse_json_body(request)
+    if isinstance(result, tuple):
+        return result
+    if not isinstance(result, list):
+        return create_response("The request body must be a JSON array.", 400)
+    return result
+
 #Prepares data for my static method validation 
 def prepare_data_dict(data, fields, model):
     # Define a dictionary that maps fields which are not defined in the model to their corresponding validation methods
@@ -69,6 +93,17 @@ def prepare_data_dict(data, fields, model):
 
 #Performs the static method validation on prepared data.
 def validate_fields(data_dict):
+    errors = get_field_errors(data_dict)
+    if errors:
+        # Only the first invalid field is reported, as an error message.
+        field_name, error = next(iter(errors.items()))
+        return create_response(f"{field_name}: {error}", 400)
+
+# Performs the static method validation on prepared data and returns the error message of every invalid field, keyed by field name.
+# This is used directly where the errors of several items are reported at once, like the bulk pantry route.
+@timed('validation')
+def get_field_errors(data_dict):
+    errors = {}
     # Iterate over each item in the data dictionary
     for field_name, field_value in data_dict.items():
         # Unpack the value into a validation function and the data to be validated
@@ -77,8 +112,9 @@ def validate_fields(data_dict):
             # Try to validate the data using the validation function
             validation_func(field_data)
         except ValidationError as e:
-            # If the validation function raises a ValidationError, return an error message
-            return create_response(f"{field_name}: {str(e)}", 400)
+            # If the validation function raises a ValidationError, record the error message
+            errors[field_name] = str(e)
+    return errors
 
 # Checks if two values match. If they don't, returns an error message.
 def check_match(value1, value2, error_message):
@@ -94,21 +130,36 @@ def check_no_change(value1, value2, error_message):
     else:
         return None
 
-# This function checks if a specific field in the User model already has a certain value.
-def check_field(User, field, value, error_message):
-    # Retrieve a user where the specified field has the specified value
-    user_with_same_field = get_model_by_field(User, field, value)
-    # Check if such a user with the specified field exists. If it does, return an error response.
-    response = check_match(user_with_same_field, None, error_message)
-    if response:
-        return response
+# Parses a query parameter that must be a whole number, returning None if it isn't one.
+# str.isdigit alone isn't enough, it also accepts characters such as '²' that int() rejects.
+def parse_whole_number(value):
+    if value.isascii() and value.isdigit():
+        return int(value)
+    return None
+
+# This function checks, in a single query, whether specific fields of a model already have certain values.
+# 'checks' is a list of (field, value, error_message). If any of the values is taken, the error of the first such field in the list is returned as a response.
+def check_fields(Model, checks):
+    conditions = [getattr(Model, field) == value for field, value, _ in checks]
+    # Each row holds, for every check, whether that row matches it.
+    rows = db.session.query(*conditions).filter(or_(*conditions)).all()
+    for index, (_, _, error_message) in enumerate(checks):
+        if any(row[index] for row in rows):
+            return create_response({'error': error_message}, 400)
 
 #Retrieves a model object based on a specific field value. 
+# The usernames and emails are stored in lowercase (the users table's check constraints enforce it), so the lookups by username pass a lowercased value
+# and are served by the unique indexes of these columns.
 def get_model_by_field(Model, field, value):
     return Model.query.filter_by(**{field: value}).scalar()
 
-# This join operation is necessary to connect the PantryItem and Pantry tables together.
-# This is because the PantryItem model doesn’t have a direct reference to the User model. By joining these tables, we can access the fields of both models in our query,
-# allowing us to filter for the current user.
-def get_user_pantry_query(user_id):
-    return PantryItem.query.join(Pantry).join(User).filter(User.id == user_id)
\ No newline at end of file
+# Returns a query for all the items in a pantry. The pantry id comes from the token claims (see get_current_pantry_id in jwt_config),
+# so there is no need to join PantryItem to Pantry and User to filter for the current user. This is a single query on the indexed pantry_items.pantry_id column.
+def get_pantry_query(pantry_id):
+    return PantryItem.query.filter(PantryItem.pantry_id == pantry_id)
+
+# Returns a query for one item of a pantry, by its normalized name (see normalize_item in pantry_bp).
+# Item names are stored normalized, which a check constraint of pantry_items enforces, so a plain equality finds the item case-insensitively
+# and is served by the unique index on (pantry_id, item).
+def get_pantry_item_query(pantry_id, normalized_item):
+    return get_pantry_query(pantry_id).filter(PantryItem.item == normalized_item)
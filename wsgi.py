@@ -0,0 +1,20 @@
+import os
+from dotenv import load_dotenv
+
+# The production entry point of the app, e.g. 'gunicorn wsgi:app'. See "Running in production" in the README for the settings.
+load_dotenv()
+
+# With SERVER_MODE=gevent every request runs in a greenlet instead of an OS thread. Waiting on the network (the database, the client)
+# switches to another request instead of blocking a thread, so one worker process can hold thousands of concurrent requests instead of one per thread.
+# It must be run with gunicorn's gevent worker: gunicorn -k gevent --worker-connections 1000 wsgi:app
+# The standard library is patched before the app is imported, so that the app's own locks, threads and sockets are cooperative too.
+if os.getenv('SERVER_MODE') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+    # psycopg2 is a C extension that does its own network I/O, so it has to be made cooperative separately.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+from app import create_app
+
+app = create_app()